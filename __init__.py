@@ -1,28 +1,46 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from trytond.modules import MODULES
 from trytond.pool import Pool
 from .product import *
 from .stock import *
-from .sale import *
-from .purchase import *
 
 
 def register():
     Pool.register(
+        Uom,
         Template,
         Product,
+        Configuration,
+        Location,
         Lot,
         Move,
+        SecondQuantitySnapshot,
         ShipmentIn,
         ShipmentOut,
         ShipmentOutReturn,
+        Period,
         PeriodCache,
         PeriodCacheLot,
         Inventory,
         InventoryLine,
-        SaleLine,
-        PurchaseLine,
         module='stock_second_uom', type_='model')
-    Pool.register(
-        ReturnSale,
-        module='stock_second_uom', type_='wizard')
+    # The extras are registered before this module, so the sale and purchase
+    # extensions are only imported when their modules are on disk. MODULES
+    # does not tell if they are installed in a database but the extensions
+    # of missing models are skipped by the setup of its pool.
+    if 'sale' in MODULES:
+        from .sale import Sale, SaleLine, ReturnSale
+        Pool.register(
+            Sale,
+            SaleLine,
+            module='stock_second_uom', type_='model')
+        Pool.register(
+            ReturnSale,
+            module='stock_second_uom', type_='wizard')
+    if 'purchase' in MODULES:
+        from .purchase import Purchase, PurchaseLine
+        Pool.register(
+            Purchase,
+            PurchaseLine,
+            module='stock_second_uom', type_='model')
@@ -1,11 +1,21 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from sql import Column
+from sql.conditionals import Coalesce
+
+from trytond.cache import Cache, freeze
 from trytond.model import fields
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from trytond.modules.product.product import STATES, DEPENDS
 
-__all__ = ['Template', 'Product']
+from .stock import (CompactQuantities, SecondUomStockMixin,
+    period_second_quantities, period_second_quantities_key,
+    products_by_location_cache)
+
+__all__ = ['Uom', 'Template', 'Product']
 __metaclass__ = PoolMeta
 
 STATES_SU = STATES.copy()
@@ -13,6 +23,83 @@ STATES_SU['required'] = Eval('use_second_uom', False)
 DEPENDS_SU = DEPENDS[:] + ['use_second_uom']
 
 
+class Uom:
+    __name__ = 'product.uom'
+    _conversion_cache = Cache('product.uom.conversion', context=False)
+    _conversion_cache_stats = {
+        'hits': 0,
+        'misses': 0,
+        }
+
+    @classmethod
+    def write(cls, *args):
+        super(Uom, cls).write(*args)
+        cls._conversion_cache.clear()
+
+    @classmethod
+    def delete(cls, uoms):
+        super(Uom, cls).delete(uoms)
+        cls._conversion_cache.clear()
+
+    @classmethod
+    def _get_conversion(cls, from_uom, to_uom):
+        """
+        Return a tuple (from accurate field, from value, to accurate field,
+        to value, to rounding) to convert quantities between the UoMs or None
+        if they are not in the same category.
+        """
+        key = (int(from_uom), int(to_uom))
+        conversion = cls._conversion_cache.get(key, -1)
+        if conversion != -1:
+            cls._conversion_cache_stats['hits'] += 1
+            return conversion
+        cls._conversion_cache_stats['misses'] += 1
+
+        from_uom, to_uom = cls(key[0]), cls(key[1])
+        conversion = None
+        if from_uom.category.id == to_uom.category.id:
+            from_field = from_uom.accurate_field
+            to_field = to_uom.accurate_field
+            conversion = (from_field, getattr(from_uom, from_field),
+                to_field, getattr(to_uom, to_field), to_uom.rounding)
+        cls._conversion_cache.set(key, conversion)
+        return conversion
+
+    @classmethod
+    def compute_qty_cached(cls, from_uom, qty, to_uom=None, round=True):
+        """
+        Convert quantity for given uom's like compute_qty but using the
+        factors stored in the conversion cache.
+        from_uom and to_uom can be instances or ids.
+        """
+        if not from_uom or not qty or not to_uom:
+            return qty
+        conversion = cls._get_conversion(from_uom, to_uom)
+        if not conversion:
+            return qty
+        from_field, from_value, to_field, to_value, rounding = conversion
+        if from_field == 'factor':
+            amount = qty * from_value
+        else:
+            amount = qty / from_value
+        if to_field == 'factor':
+            amount = amount / to_value
+        else:
+            amount = amount * to_value
+        if round:
+            amount = cls.round(amount, rounding)
+        return amount
+
+    @classmethod
+    def conversion_cache_stats(cls, reset=False):
+        "Return the hits and misses of the conversion cache of this process"
+        stats = cls._conversion_cache_stats.copy()
+        if reset:
+            for key in cls._conversion_cache_stats:
+                cls._conversion_cache_stats[key] = 0
+        return stats
+
+
 class Template:
     __name__ = "product.template"
     use_second_uom = fields.Function(fields.Boolean('Use Second UOM'),
@@ -23,12 +110,12 @@ class Template:
             states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'sum_product')
+        'get_second_quantity')
     second_forecast_quantity = fields.Function(
         fields.Float('Second UoM Forecast Quantity', states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'sum_product')
+        'get_second_quantity')
 
     @classmethod
     def __setup__(cls):
@@ -53,18 +140,54 @@ class Template:
     def search_use_second_uom(cls, name, clause):
         return [('products.use_second_uom', ) + tuple(clause[1:])]
 
-    def sum_product(self, name):
-        if name in ('second_quantity', 'second_forecast_quantity'):
-            sum_ = 0.
-            for product in self.products:
-                qty = getattr(product, name)
-                if qty:
-                    sum_ += qty
-            return sum_
-        return super(Template, self).sum_product(name)
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super(Template, cls).write(*args)
+        actions = iter(args)
+        template_ids = set()
+        clear_cache = False
+        for templates, values in zip(actions, actions):
+            if 'second_uom' in values:
+                template_ids.update(t.id for t in templates)
+            clear_cache |= 'active' in values
+        if template_ids:
+            # The inactive variants keep their moves
+            with Transaction().set_context(active_test=False):
+                products = Product.search([
+                        ('template', 'in', list(template_ids)),
+                        ])
+            Product.store_second_uom_values([p.id for p in products])
+        if template_ids or clear_cache:
+            products_by_location_cache().clear()
+
+    @classmethod
+    def get_second_quantity(cls, templates, names):
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        # Compute the quantities of the products of all templates at once,
+        # including the inactive variants which may still have stock
+        with Transaction().set_context(active_test=False):
+            products = Product.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ])
+        if products:
+            quantities = Product.get_quantity(products, names)
+        else:
+            quantities = dict((n, {}) for n in names)
+        result = {}
+        for name in names:
+            result[name] = dict.fromkeys((t.id for t in templates), 0.)
+            for product in products:
+                result[name][product.template.id] += (
+                    quantities[name].get(product.id) or 0.)
+        return result
 
 
-class Product:
+class Product(SecondUomStockMixin):
+    __metaclass__ = PoolMeta
     __name__ = "product.product"
     use_second_uom = fields.Boolean('Use Second UoM', states=STATES,
         depends=DEPENDS)
@@ -74,12 +197,16 @@ class Product:
             states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'get_quantity', searcher='search_quantity')
+        'get_quantity', searcher='search_second_quantity')
     second_forecast_quantity = fields.Function(
         fields.Float('Second UoM Forecast Quantity', states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'get_quantity', searcher='search_quantity')
+        'get_quantity', searcher='search_second_quantity')
+    _products_by_location_cache_stats = {
+        'hits': 0,
+        'misses': 0,
+        }
 
     @classmethod
     def __setup__(cls):
@@ -89,9 +216,115 @@ class Product:
                     'template because product "%s" is set to Use Second UoM.'),
                 })
 
-    def get_second_uom(self, name):
-        if self.template.second_uom:
-            return self.template.second_uom.id
+    @classmethod
+    def get_second_uom(cls, products, name):
+        values = cls.get_second_uom_values([p.id for p in products])
+        return dict((p.id, values[p.id][1]) for p in products)
+
+    @classmethod
+    def write(cls, *args):
+        super(Product, cls).write(*args)
+        actions = iter(args)
+        product_ids = set()
+        clear_cache = False
+        for products, values in zip(actions, actions):
+            if 'use_second_uom' in values:
+                product_ids.update(p.id for p in products)
+            clear_cache |= 'active' in values
+        if product_ids:
+            cls.store_second_uom_values(list(product_ids))
+        if product_ids or clear_cache:
+            products_by_location_cache().clear()
+
+    @classmethod
+    def store_second_uom_values(cls, product_ids=None, models=None):
+        '''
+        Store the use second UoM flag and the second UoM category of the
+        products on the records of models (by default moves and lots).
+        All the products are stored if product_ids is None.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        cursor = Transaction().cursor
+
+        if models is None:
+            models = [Move]
+            if 'lot' in Move._fields:
+                models.append(pool.get('stock.lot'))
+        if product_ids is None:
+            product = cls.__table__()
+            cursor.execute(*product.select(product.id))
+            product_ids = [i for i, in cursor.fetchall()]
+
+        product_ids_by_values = {}
+        for product_id, (use_second_uom, _, category_id, _) in (
+                cls.get_second_uom_values(product_ids).iteritems()):
+            if not use_second_uom:
+                category_id = None
+            product_ids_by_values.setdefault((use_second_uom, category_id),
+                []).append(product_id)
+
+        for Model in models:
+            table = Model.__table__()
+            for values, ids in product_ids_by_values.iteritems():
+                for sub_ids in grouped_slice(ids):
+                    cursor.execute(*table.update(
+                            columns=[table.use_second_uom,
+                                table.product_second_uom_category],
+                            values=list(values),
+                            where=reduce_ids(table.product, sub_ids)))
+
+    @classmethod
+    def recompute_second_quantities(cls, product_ids, start_id=0,
+            commit=False):
+        """
+        Recompute the stored second UoM values and the second internal
+        quantities of the moves and period caches of the products, for
+        example after the second UoM of their template was changed.
+        See Move.recompute_second_internal_quantities for start_id and commit.
+
+        Return the number of updated moves.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+
+        cls.store_second_uom_values(product_ids)
+        updated = Move.recompute_second_internal_quantities(product_ids,
+            start_id=start_id, commit=commit)
+        Period.recompute_second_internal_quantities(product_ids,
+            commit=commit)
+        return updated
+
+    @classmethod
+    def get_second_uom_values(cls, product_ids):
+        '''
+        Return a dictionary with product id as key and a tuple of use second
+        UoM, second UoM id, second UoM category id and second UoM digits as
+        value
+        '''
+        pool = Pool()
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        cursor = Transaction().cursor
+        product = cls.__table__()
+        template = Template.__table__()
+        uom = Uom.__table__()
+
+        values = {}
+        for sub_ids in grouped_slice(set(product_ids)):
+            cursor.execute(*product.join(template,
+                    condition=product.template == template.id
+                    ).join(uom, 'LEFT',
+                    condition=template.second_uom == uom.id
+                    ).select(product.id, product.use_second_uom, uom.id,
+                    uom.category, uom.digits,
+                    where=reduce_ids(product.id, sub_ids)))
+            for (product_id, use_second_uom, uom_id, category_id,
+                    digits) in cursor.fetchall():
+                values[product_id] = (bool(use_second_uom), uom_id,
+                    category_id, digits)
+        return values
 
     @classmethod
     def search_second_uom(cls, name, clause):
@@ -107,6 +340,191 @@ class Product:
         if self.use_second_uom and not self.template.second_uom:
             self.raise_user_error('second_uom_required', self.rec_name)
 
+    @classmethod
+    def get_quantity(cls, products, names):
+        get_quantity = super(Product, cls).get_quantity
+        if isinstance(names, basestring):
+            return get_quantity(products, names)
+        location_ids = Transaction().context.get('locations')
+        return cls._get_quantities(products, names, get_quantity,
+            location_ids, products)
+
+    @classmethod
+    def search_second_quantity(cls, name, domain=None):
+        location_ids = Transaction().context.get('locations')
+        return cls._search_second_quantity(name, location_ids, domain)
+
+    @classmethod
+    def products_by_location(cls, location_ids, product_ids=None,
+            with_childs=False, grouping=('product',)):
+        context = Transaction().context
+        if (context.get('_second_uom_period_close')
+                and not context.get('second_uom')
+                and not with_childs):
+            # Keep the second quantities of the same locations and context
+            # for the period caches
+            quantities = super(Product, cls).products_by_location(
+                location_ids, product_ids=product_ids,
+                with_childs=with_childs, grouping=grouping)
+            key = period_second_quantities_key(grouping,
+                context['stock_date_end'], location_ids, product_ids)
+            period_second_quantities()[key] = (
+                cls.products_by_location_compact(location_ids,
+                    product_ids=product_ids, grouping=grouping))
+            return quantities
+        if not context.get('second_uom'):
+            return super(Product, cls).products_by_location(location_ids,
+                product_ids=product_ids, with_childs=with_childs,
+                grouping=grouping)
+
+        # The second quantities are cached until a move is changed
+        cache = products_by_location_cache()
+        key = cls._products_by_location_cache_key(location_ids, product_ids,
+            with_childs, grouping)
+        quantities = cache.get(key)
+        if quantities is not None:
+            cls._products_by_location_cache_stats['hits'] += 1
+            return quantities.copy()
+        cls._products_by_location_cache_stats['misses'] += 1
+        quantities = super(Product, cls).products_by_location(location_ids,
+            product_ids=product_ids, with_childs=with_childs,
+            grouping=grouping)
+        cache[key] = quantities.copy()
+        return quantities
+
+    @classmethod
+    def products_by_location_compact(cls, location_ids, product_ids=None,
+            with_childs=False, grouping=('product',)):
+        """
+        Compute the second quantities like products_by_location with
+        second_uom in the context but return them as a CompactQuantities.
+
+        Without with_childs nor stock_skip_warehouse, the rows are read sorted
+        from the database without building a dictionary.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Uom = pool.get('product.uom')
+        width = len(grouping) + 1
+
+        if with_childs or Transaction().context.get('stock_skip_warehouse'):
+            with Transaction().set_context(second_uom=True):
+                return CompactQuantities.from_dict(width,
+                    cls.products_by_location(location_ids,
+                        product_ids=product_ids, with_childs=with_childs,
+                        grouping=grouping))
+
+        cache = products_by_location_cache()
+        grouping_filter = (product_ids,) + tuple(None for k in grouping[1:])
+        with Transaction().set_context(second_uom=True):
+            key = ('compact',) + cls._products_by_location_cache_key(
+                location_ids, product_ids, with_childs, grouping)
+            quantities = cache.get(key)
+            if quantities is not None:
+                cls._products_by_location_cache_stats['hits'] += 1
+                return quantities
+            cls._products_by_location_cache_stats['misses'] += 1
+            query = Move.compute_quantities_query(location_ids,
+                with_childs=False, grouping=grouping,
+                grouping_filter=grouping_filter)
+        if query is None:
+            return CompactQuantities(width)
+
+        columns = [Column(query, name)
+            for name in ('location',) + tuple(grouping)]
+        cursor = Transaction().cursor
+        cursor.execute(*query.select(*(columns + [query.quantity]),
+                order_by=[Coalesce(c, 0) for c in columns]))
+        quantities = CompactQuantities.from_cursor(width, cursor)
+
+        # Round quantities like products_by_location does
+        product_column = quantities.columns[grouping.index('product') + 1]
+        roundings = {}
+        for sub_ids in grouped_slice(list(set(product_column))):
+            for product in cls.browse(list(sub_ids)):
+                roundings[product.id] = product.default_uom.rounding
+        values = quantities.quantities
+        for index, product_id in enumerate(product_column):
+            values[index] = Uom.round(values[index], roundings[product_id])
+        cache[key] = quantities
+        return quantities
+
+    @classmethod
+    def _products_by_location_cache_key(cls, location_ids, product_ids,
+            with_childs, grouping):
+        "Return the key of the products_by_location cache for the context"
+        context = Transaction().context
+        return (tuple(sorted(location_ids)),
+            tuple(sorted(product_ids)) if product_ids is not None else None,
+            with_childs, tuple(grouping), Transaction().user,
+            tuple(freeze(context.get(k))
+                for k in cls._products_by_location_cache_context()))
+
+    @staticmethod
+    def _products_by_location_cache_context():
+        "Return the context keys changing the result of products_by_location"
+        return ('stock_date_end', 'stock_date_start', 'forecast',
+            'stock_assign', 'stock_destinations', 'stock_skip_warehouse',
+            'second_uom', 'company')
+
+    @classmethod
+    def products_by_location_cache_stats(cls, reset=False):
+        "Return the hits and misses of the second UoM products_by_location"
+        stats = cls._products_by_location_cache_stats.copy()
+        if reset:
+            for key in cls._products_by_location_cache_stats:
+                cls._products_by_location_cache_stats[key] = 0
+        return stats
+
+    @classmethod
+    def products_by_location_both(cls, location_ids, product_ids=None,
+            with_childs=False, grouping=('product',)):
+        """
+        Compute for each location and product the stock quantity in the default
+        uom of the product and the second internal quantity with one query.
+
+        See products_by_location for the parameters.
+
+        Return two dictionaries with location id and grouping as key
+                and the quantity and the second quantity as value.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        # Skip warehouse location in favor of their storage location
+        # like products_by_location
+        storage_to_remove = set()
+        wh_to_add = {}
+        if Transaction().context.get('stock_skip_warehouse'):
+            location_ids = set(location_ids)
+            for location in Location.browse(list(location_ids)):
+                if location.type == 'warehouse':
+                    location_ids.remove(location.id)
+                    if location.storage_location.id not in location_ids:
+                        storage_to_remove.add(location.storage_location.id)
+                    location_ids.add(location.storage_location.id)
+                    wh_to_add[location.id] = location.storage_location.id
+            location_ids = list(location_ids)
+
+        grouping_filter = (product_ids,) + tuple(None for k in grouping[1:])
+        with Transaction().set_context(second_uom='both'):
+            query = Move.compute_quantities_query(location_ids, with_childs,
+                grouping=grouping, grouping_filter=grouping_filter)
+        if query is None:
+            return {}, {}
+        pbls = Move.compute_quantities_both(query, location_ids, with_childs,
+            grouping=grouping, grouping_filter=grouping_filter)
+
+        for quantities in pbls:
+            for wh, storage in wh_to_add.iteritems():
+                for key in quantities.keys():
+                    if key[0] == storage:
+                        quantities[(wh,) + key[1:]] = quantities[key]
+                        if storage in storage_to_remove:
+                            del quantities[key]
+        return pbls
+
     @classmethod
     def _quantity_context(cls, name):
         if name.startswith('second_'):
@@ -4,7 +4,10 @@ from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 
-__all__ = ['PurchaseLine']
+from .stock import (get_moved_second_quantities, get_prepared_values,
+    instrumented, prepared_values)
+
+__all__ = ['Purchase', 'PurchaseLine']
 __metaclass__ = PoolMeta
 
 STATES = {
@@ -15,6 +18,16 @@ STATES = {
 DEPENDS = ['type', 'use_second_unit']
 
 
+class Purchase:
+    __name__ = 'purchase.purchase'
+
+    def create_move(self, move_type):
+        PurchaseLine = Pool().get('purchase.line')
+        with prepared_values('purchase_line_moved_second_quantities',
+                PurchaseLine.get_moved_second_quantities(self.lines)):
+            return super(Purchase, self).create_move(move_type)
+
+
 class PurchaseLine:
     __name__ = 'purchase.line'
     use_second_unit = fields.Function(fields.Boolean('Use Second Unit'),
@@ -62,6 +75,14 @@ class PurchaseLine:
                 res['second_unit_digits'] = self.product.second_uom.digits
         return res
 
+    @classmethod
+    def get_moved_second_quantities(cls, lines):
+        "Return the second quantity of the moves of lines in their unit"
+        return get_moved_second_quantities(
+            [l for l in lines if l.use_second_unit],
+            'purchase.line-recreated-stock.move', 'purchase_line')
+
+    @instrumented('PurchaseLine.get_move')
     def get_move(self):
         pool = Pool()
         Uom = pool.get('product.uom')
@@ -69,15 +90,11 @@ class PurchaseLine:
         move = super(PurchaseLine, self).get_move()
 
         if move and self.use_second_unit:
-            skip = set(self.moves_recreated)
-            second_quantity = abs(self.second_quantity)
-            for move in self.moves:
-                if move not in skip:
-                    second_quantity -= Uom.compute_qty(
-                        move.second_uom,
-                        move.second_quantity,
-                        self.second_unit)
-
+            moved = get_prepared_values(
+                'purchase_line_moved_second_quantities')
+            if self.id not in moved:
+                moved = self.get_moved_second_quantities([self])
+            second_quantity = abs(self.second_quantity) - moved[self.id]
             second_quantity = max(
                 Uom.round(second_quantity, self.second_unit.rounding), 0)
             move.second_quantity = second_quantity
@@ -4,7 +4,10 @@ from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 
-__all__ = ['SaleLine', 'ReturnSale']
+from .stock import (get_moved_second_quantities, get_prepared_values,
+    instrumented, prepared_values)
+
+__all__ = ['Sale', 'SaleLine', 'ReturnSale']
 __metaclass__ = PoolMeta
 
 STATES = {
@@ -15,6 +18,16 @@ STATES = {
 DEPENDS = ['type', 'use_second_unit']
 
 
+class Sale:
+    __name__ = 'sale.sale'
+
+    def _get_move_sale_line(self, shipment_type):
+        SaleLine = Pool().get('sale.line')
+        with prepared_values('sale_line_moved_second_quantities',
+                SaleLine.get_moved_second_quantities(self.lines)):
+            return super(Sale, self)._get_move_sale_line(shipment_type)
+
+
 class SaleLine:
     __name__ = 'sale.line'
     use_second_unit = fields.Function(fields.Boolean('Use Second Unit'),
@@ -62,6 +75,14 @@ class SaleLine:
                 res['second_unit_digits'] = self.product.second_uom.digits
         return res
 
+    @classmethod
+    def get_moved_second_quantities(cls, lines):
+        "Return the second quantity of the moves of lines in their unit"
+        return get_moved_second_quantities(
+            [l for l in lines if l.use_second_unit],
+            'sale.line-recreated-stock.move', 'sale_line')
+
+    @instrumented('SaleLine.get_move')
     def get_move(self, shipment_type):
         pool = Pool()
         Uom = pool.get('product.uom')
@@ -69,15 +90,11 @@ class SaleLine:
         move = super(SaleLine, self).get_move(shipment_type)
 
         if move and self.use_second_unit:
-            skip = set(self.moves_recreated)
-            second_quantity = abs(self.second_quantity)
-            for move in self.moves:
-                if move not in skip:
-                    second_quantity -= Uom.compute_qty(
-                        move.second_uom,
-                        move.second_quantity,
-                        self.second_unit)
-
+            moved = get_prepared_values(
+                'sale_line_moved_second_quantities')
+            if self.id not in moved:
+                moved = self.get_moved_second_quantities([self])
+            second_quantity = abs(self.second_quantity) - moved[self.id]
             second_quantity = max(
                 Uom.round(second_quantity, self.second_unit.rounding), 0)
             move.second_quantity = second_quantity
@@ -89,14 +106,25 @@ class ReturnSale:
     __name__ = 'sale.return_sale'
 
     def do_return_(self, action):
-        Sale = Pool().get('sale.sale')
+        SaleLine = Pool().get('sale.line')
 
         action, data = super(ReturnSale, self).do_return_(action)
         return_sale_ids = data.get('res_id', [])
         if return_sale_ids:
-            for sale in Sale.browse(return_sale_ids):
-                for line in sale.lines:
-                    if line.second_quantity:
-                        line.second_quantity *= -1
-                        line.save()
+            lines = SaleLine.search([
+                    ('sale', 'in', return_sale_ids),
+                    ('second_quantity', '!=', None),
+                    ('second_quantity', '!=', 0),
+                    ])
+            lines_by_quantity = {}
+            for line in lines:
+                lines_by_quantity.setdefault(-line.second_quantity,
+                    []).append(line)
+            to_write = []
+            for second_quantity, lines in lines_by_quantity.iteritems():
+                to_write.extend((lines, {
+                            'second_quantity': second_quantity,
+                            }))
+            if to_write:
+                SaleLine.write(*to_write)
         return action, data
@@ -1,17 +1,32 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from sql import Join, Literal, Select, Table, Union
-from sql.aggregate import Sum
-from sql.conditionals import Coalesce
+import logging
+import operator
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from sql import Column, Join, Literal, Select, Table, Union
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Abs
 from sql.operators import Neg
 
-from trytond.model import fields
+from trytond import backend
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, In
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
-__all__ = ['Lot', 'Move', 'ShipmentIn', 'ShipmentOut', 'ShipmentOutReturn',
-    'PeriodCache', 'PeriodCacheLot', 'Inventory', 'InventoryLine']
+__all__ = ['Configuration', 'Location', 'Lot', 'Move',
+    'SecondQuantitySnapshot', 'ShipmentIn', 'ShipmentOut',
+    'ShipmentOutReturn', 'Period', 'PeriodCache', 'PeriodCacheLot',
+    'Inventory', 'InventoryLine']
 __metaclass__ = PoolMeta
 
 STATES = {
@@ -20,39 +35,710 @@ STATES = {
     }
 DEPENDS = ['state', 'use_second_uom']
 
+logger = logging.getLogger(__name__)
+
+
+def _transaction_storage():
+    """
+    Return the dictionary of the module stored on the cursor of the
+    transaction, apart from its model cache. It ends with the transaction.
+    """
+    cursor = Transaction().cursor
+    try:
+        return cursor.stock_second_uom_storage
+    except AttributeError:
+        storage = cursor.stock_second_uom_storage = {}
+        return storage
+
+
+def transaction_cache(name, size_limit=1024):
+    "Return a LRUDict stored for the transaction"
+    return _transaction_storage().setdefault(('cache', name),
+        LRUDict(size_limit))
+
+
+@contextmanager
+def _query_counter():
+    """
+    Yield a list with the number of queries executed by the cursor until the
+    end of the block.
+    """
+    cursor = Transaction().cursor
+    execute = cursor.execute
+    counter = [0]
+
+    def counted_execute(*args, **kwargs):
+        counter[0] += 1
+        return execute(*args, **kwargs)
+    cursor.execute = counted_execute
+    try:
+        yield counter
+    finally:
+        cursor.execute = execute
+
+
+def _default_rows(self, records=None, *args, **kwargs):
+    if isinstance(records, (list, tuple)):
+        return len(records)
+    return 1
+
+
+def _write_rows(cls, *args):
+    return sum(len(records) for records in args[::2])
+
+
+def instrumented(name, rows=_default_rows):
+    """
+    Decorate a method to record its calls, wall time, processed rows and
+    executed queries when the context has second_uom_instrumentation or the
+    logger of the module is at debug level.
+    rows is called with the arguments of the method to return the number of
+    processed rows, by default the length of its first argument. If rows is
+    None, the processed rows are not recorded.
+    The records are returned by instrumentation_stats.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (Transaction().context.get('second_uom_instrumentation')
+                    or logger.isEnabledFor(logging.DEBUG)):
+                return func(*args, **kwargs)
+            nb_rows = rows(*args, **kwargs) if rows else None
+            start = time.time()
+            with _query_counter() as queries:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    duration = time.time() - start
+                    nb_queries = queries[0]
+                    keys = ['calls', 'time', 'queries']
+                    if rows:
+                        keys.append('rows')
+                    stats = transaction_cache('instrumentation').setdefault(
+                        name, dict.fromkeys(keys, 0))
+                    stats['calls'] += 1
+                    stats['time'] += duration
+                    stats['queries'] += nb_queries
+                    if rows:
+                        stats['rows'] += nb_rows
+                        logger.debug('%s: %s rows in %.6fs with %s queries',
+                            name, nb_rows, duration, nb_queries)
+                    else:
+                        logger.debug('%s: %.6fs with %s queries',
+                            name, duration, nb_queries)
+        return wrapper
+    return decorator
+
+
+def instrumentation_stats(reset=False):
+    """
+    Return a dictionary with the name of the instrumented methods as key and
+    a dictionary with the calls, time, queries and rows (if recorded) of the
+    transaction as value.
+    """
+    cache = transaction_cache('instrumentation')
+    stats = dict((k, v.copy()) for k, v in cache.iteritems())
+    if reset:
+        cache.clear()
+    return stats
+
+
+def products_by_location_cache():
+    """
+    Return the cache of the second UoM products_by_location of the
+    transaction. Its size is set by products_by_location_cache in the
+    stock_second_uom section of the configuration.
+    """
+    return transaction_cache('products_by_location',
+        config.getint('stock_second_uom', 'products_by_location_cache', 64))
+
+
+class CompactQuantities(object):
+    """
+    Read-only mapping of keys (location and grouping ids) to quantities like
+    the dictionary of products_by_location but stored in parallel typed
+    arrays sorted by key and searched by bisection.
+    None ids are stored as 0.
+    """
+
+    def __init__(self, width):
+        self.columns = tuple(array('l') for _ in xrange(width))
+        self.quantities = array('d')
+
+    @classmethod
+    def from_rows(cls, width, rows):
+        "Return an instance filled with rows of ids and quantity sorted by ids"
+        quantities = cls(width)
+        columns = quantities.columns
+        previous = None
+        for row in rows:
+            key = tuple(i or 0 for i in row[:width])
+            assert previous is None or previous < key, 'rows are not sorted'
+            previous = key
+            for column, id_ in zip(columns, key):
+                column.append(id_)
+            quantities.quantities.append(row[width] or 0.0)
+        return quantities
+
+    @classmethod
+    def from_cursor(cls, width, cursor, size=1000):
+        "Return an instance filled with the sorted rows of an executed query"
+        def rows():
+            while True:
+                chunk = cursor.fetchmany(size)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield row
+        return cls.from_rows(width, rows())
 
-class Lot:
+    @classmethod
+    def from_dict(cls, width, quantities):
+        "Return an instance filled with the items of a quantities dictionary"
+        return cls.from_rows(width, sorted(
+                key + (quantity,) for key, quantity in quantities.iteritems()))
+
+    def _key(self, index):
+        return tuple(column[index] for column in self.columns)
+
+    def _index(self, key):
+        "Return the index of key or -1"
+        if len(key) != len(self.columns):
+            return -1
+        key = tuple(i or 0 for i in key)
+        lo, hi = 0, len(self.quantities)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.quantities) and self._key(lo) == key:
+            return lo
+        return -1
+
+    def __len__(self):
+        return len(self.quantities)
+
+    def __contains__(self, key):
+        return self._index(key) >= 0
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        return self.quantities[index]
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        if index < 0:
+            return default
+        return self.quantities[index]
+
+    def iterkeys(self):
+        for index in xrange(len(self.quantities)):
+            yield tuple(i or None for i in self._key(index))
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for index, key in enumerate(self.iterkeys()):
+            yield key, self.quantities[index]
+
+    def itervalues(self):
+        return iter(self.quantities)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return self.quantities.tolist()
+
+
+@contextmanager
+def prepared_values(name, values):
+    "Store values for the transaction while in the context"
+    storage = _transaction_storage()
+    key = ('prepared', name)
+    storage[key] = values
+    try:
+        yield
+    finally:
+        storage.pop(key, None)
+
+
+def get_prepared_values(name):
+    "Return the values stored by prepared_values or an empty dictionary"
+    return _transaction_storage().get(('prepared', name), {})
+
+
+def get_moved_second_quantities(lines, recreated_name, line_field):
+    """
+    Return a dictionary with the id of the sale or purchase lines as key and
+    the second quantity of their moves, without the recreated ones, in the
+    second unit of the line as value
+    """
+    pool = Pool()
+    Move = pool.get('stock.move')
+    Recreated = pool.get(recreated_name)
+    Uom = pool.get('product.uom')
+    cursor = Transaction().cursor
+    move = Move.__table__()
+    recreated = Recreated.__table__()
+
+    lines = dict((l.id, l) for l in lines)
+    quantities = dict.fromkeys(lines, 0.)
+    for sub_ids in grouped_slice(lines.keys()):
+        sub_ids = list(sub_ids)
+        model_name = lines[sub_ids[0]].__name__
+        origins = ['%s,%s' % (model_name, i) for i in sub_ids]
+        cursor.execute(*move.select(move.origin, move.second_uom,
+                move.second_quantity, Count(move.id),
+                where=move.origin.in_(origins)
+                & ~move.id.in_(recreated.select(recreated.move,
+                        where=reduce_ids(Column(recreated, line_field),
+                            sub_ids))),
+                group_by=[move.origin, move.second_uom,
+                    move.second_quantity]))
+        for origin, uom_id, quantity, count in cursor.fetchall():
+            line = lines[int(origin.split(',')[1])]
+            # Each move is converted and rounded like with compute_qty, once
+            # by UoM and quantity of the moves
+            quantities[line.id] += count * Uom.compute_qty_cached(uom_id,
+                quantity or 0., line.second_unit)
+    return quantities
+
+
+def set_second_uom_values(vlist):
+    "Set on vlist the use second UoM flag and category of their product"
+    Product = Pool().get('product.product')
+    values = Product.get_second_uom_values(
+        [v['product'] for v in vlist if v.get('product')])
+    for vals in vlist:
+        if not vals.get('product'):
+            continue
+        use_second_uom, _, category_id, _ = values[vals['product']]
+        vals['use_second_uom'] = use_second_uom
+        vals['product_second_uom_category'] = (category_id if use_second_uom
+            else None)
+
+
+def set_second_uom_write_values(args):
+    "Return the write arguments with the second UoM values of the product"
+    args = list(args)
+    to_set = []
+    for i in range(1, len(args), 2):
+        if args[i].get('product'):
+            args[i] = args[i].copy()
+            to_set.append(args[i])
+    set_second_uom_values(to_set)
+    return args
+
+
+def _find_table(from_item, tables):
+    "Return the path to the first table of tables in from_item or None"
+    stack = [(from_item, ())]
+    while stack:
+        item, path = stack.pop(0)
+        if isinstance(item, Table):
+            if item._name in tables:
+                return path
+        elif isinstance(item, Join):
+            stack.append((item.left, path + ('left',)))
+            stack.append((item.right, path + ('right',)))
+
+
+def _union_shape(union):
+    """
+    Return the path, the number of from items and of columns of each select
+    of union in order.
+    """
+    shape = []
+    stack = [(union, ())]
+    while stack:
+        query, path = stack.pop(0)
+        if isinstance(query, Union):
+            stack[0:0] = [(q, path + (i,))
+                for i, q in enumerate(query.queries)]
+        elif isinstance(query, Select):
+            shape.append((path, len(query.from_), len(query.columns)))
+        else:
+            shape.append((path, None, None))
+    return tuple(shape)
+
+
+def _quantity_plan(union, tables):
+    """
+    Return the shape of union and a tuple of (query path, table path, column
+    index, negative) for each select of union on one of the tables with a
+    quantity column.
+    """
+    plan = []
+    stack = [(union, ())]
+    while stack:
+        query, path = stack.pop(0)
+        if isinstance(query, Union):
+            stack[0:0] = [(q, path + (i,))
+                for i, q in enumerate(query.queries)]
+            continue
+        elif not isinstance(query, Select):
+            continue
+        for i, from_item in enumerate(query.from_):
+            table_path = _find_table(from_item, tables)
+            if table_path is not None:
+                table_path = (i,) + table_path
+                break
+        else:
+            continue
+        for index, column in enumerate(query.columns):
+            if getattr(column, 'output_name', None) == 'quantity':
+                plan.append((path, table_path, index,
+                        isinstance(column.expression, Neg)))
+    return _union_shape(union), tuple(plan)
+
+
+def _resolve_quantity_plan(union, plan, tables):
+    """
+    Return a list of (select, table, column index, negative) for the plan
+    applied to union or None if union does not match the plan.
+    """
+    shape, plan = plan
+    # The number and the order of the selects must be the same
+    if _union_shape(union) != shape:
+        return None
+    resolved = []
+    try:
+        for path, table_path, index, negative in plan:
+            query = union
+            for i in path:
+                query = query.queries[i]
+            table = query.from_[table_path[0]]
+            for side in table_path[1:]:
+                table = getattr(table, side)
+            column = query.columns[index]
+            if (not isinstance(query, Select)
+                    or not isinstance(table, Table)
+                    or table._name not in tables
+                    or column.output_name != 'quantity'
+                    or isinstance(column.expression, Neg) != negative):
+                return None
+            resolved.append((query, table, index, negative))
+    except (AttributeError, IndexError, TypeError):
+        return None
+    return resolved
+
+
+# Python operators to know if a quantity of zero matches a search clause
+QUANTITY_OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda quantity, value: quantity in value,
+    'not in': lambda quantity, value: quantity not in value,
+    }
+
+
+def rounded_condition(operator_, quantity, value, tolerance):
+    """
+    Return the SQL condition comparing quantity to value with operator_ where
+    the quantities closer than tolerance to value are considered equal.
+    """
+    if operator_ in ('in', 'not in'):
+        if not value:
+            return Literal(operator_ == 'not in')
+        if operator_ == 'in':
+            conditions = [rounded_condition('=', quantity, v, tolerance)
+                for v in value]
+            return reduce(operator.or_, conditions)
+        conditions = [rounded_condition('!=', quantity, v, tolerance)
+            for v in value]
+        return reduce(operator.and_, conditions)
+    if operator_ == '=':
+        return Abs(quantity - value) <= tolerance
+    elif operator_ == '!=':
+        return Abs(quantity - value) > tolerance
+    elif operator_ == '<':
+        return quantity + tolerance < value
+    elif operator_ == '<=':
+        return quantity - tolerance <= value
+    elif operator_ == '>':
+        return quantity - tolerance > value
+    elif operator_ == '>=':
+        return quantity + tolerance >= value
+
+
+class SecondUomStockMixin(object):
+    '''Mixin class with helpers to compute second UoM stock quantities.'''
+
+    @classmethod
+    def _get_quantities(cls, records, names, get_quantity, location_ids,
+            products=None, grouping=('product',), position=-1):
+        """
+        Compute the stock quantities of names for each record.
+
+        When a quantity and its second quantity are both in names, they are
+        computed by the same query. The other names are computed by
+        get_quantity(records, name).
+        See StockMixin._get_quantity for the other parameters.
+
+        Return a dictionary with name as key and a dictionary with record id
+            as key and quantity as value as value.
+        """
+        result = {}
+        for name in names:
+            if name in result:
+                continue
+            base_name = name[7:] if name.startswith('second_') else name
+            second_name = 'second_' + base_name
+            if base_name in names and second_name in names:
+                result[base_name], result[second_name] = (
+                    cls._get_quantity_both(records, base_name, location_ids,
+                        products=products, grouping=grouping,
+                        position=position))
+            else:
+                result[name] = get_quantity(records, name)
+        return result
+
+    @classmethod
+    def _get_quantity_both(cls, records, name, location_ids, products=None,
+            grouping=('product',), position=-1):
+        """
+        Compute for each record the stock quantity of name and its second
+        quantity like StockMixin._get_quantity.
+
+        Return two dictionaries with record id as key and the quantity and
+            the second quantity as value.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        record_ids = [r.id for r in records]
+        quantities = dict.fromkeys(record_ids, 0.0)
+        second_quantities = dict.fromkeys(record_ids, 0.0)
+        if not location_ids:
+            return quantities, second_quantities
+
+        product_ids = products and [p.id for p in products] or None
+
+        with Transaction().set_context(cls._quantity_context(name)):
+            pbls = Product.products_by_location_both(location_ids,
+                product_ids=product_ids, with_childs=True, grouping=grouping)
+
+        for pbl, values in zip(pbls, (quantities, second_quantities)):
+            for key, quantity in pbl.iteritems():
+                if key[position] is not None and key[position] in values:
+                    values[key[position]] += quantity
+        return quantities, second_quantities
+
+    @classmethod
+    def _search_second_quantity(cls, name, location_ids, domain=None,
+            grouping=('product',), position=-1):
+        """
+        Compute the domain to filter records which validates the domain over
+        the quantity field like StockMixin._search_quantity but the
+        comparison is done by a HAVING clause on compute_quantities_query
+        and the ids are selected by the database.
+
+        The quantities of the child locations are summed in the query using
+        the left and right of the locations and they are compared within half
+        the rounding of the default UoM of the product, which rounds the
+        quantities of get_quantity. The other operators use
+        StockMixin._search_quantity.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        if not location_ids or not domain:
+            return []
+        _, operator_, value = domain
+        if operator_ not in QUANTITY_OPERATORS or value is None:
+            return cls._search_quantity(name, location_ids, domain,
+                grouping=grouping, position=position)
+
+        if Transaction().context.get('stock_skip_warehouse'):
+            location_ids = set(location_ids)
+            for location in Location.browse(list(location_ids)):
+                if location.type == 'warehouse':
+                    location_ids.remove(location.id)
+                    location_ids.add(location.storage_location.id)
+        location_ids = list(set(location_ids))
+
+        with Transaction().set_context(cls._quantity_context(name)):
+            query = Move.compute_quantities_query(location_ids,
+                with_childs=True, grouping=grouping, grouping_filter=None)
+        if query is None:
+            return [('id', '=', None)]
+
+        location = Location.__table__()
+        parent = Location.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        uom = Uom.__table__()
+        from_ = query.join(location,
+            condition=query.location == location.id
+            ).join(parent,
+                condition=(location.left >= parent.left)
+                & (location.right <= parent.right)
+            ).join(product, condition=query.product == product.id
+            ).join(template, condition=product.template == template.id
+            ).join(uom, condition=template.default_uom == uom.id)
+        keys = [Column(query, key) for key in grouping]
+        record = keys[position]
+        quantity = Coalesce(Sum(query.quantity), Literal(0))
+        tolerance = Max(uom.rounding) / 2
+        condition = rounded_condition(operator_, quantity, value, tolerance)
+
+        # Records without moves in a location have a quantity of zero there
+        if QUANTITY_OPERATORS[operator_](0.0, value):
+            # Select the records that do not match in any location
+            locations = from_.select(parent.id.as_('location'),
+                record.as_('record'),
+                where=parent.id.in_(location_ids) & (record != None),
+                group_by=[parent.id] + keys,
+                having=~condition)
+            return [('id', 'not in', locations.select(locations.record,
+                        group_by=[locations.record],
+                        having=Count(locations.location)
+                        == len(location_ids)))]
+        return [('id', 'in', from_.select(record,
+                    where=parent.id.in_(location_ids) & (record != None),
+                    group_by=[parent.id] + keys,
+                    having=condition))]
+
+
+class Configuration:
+    __name__ = 'stock.configuration'
+    second_quantity_snapshot = fields.Boolean('Second Quantity Snapshot',
+        help='Keep the second quantities of done moves by location in a '
+        'table to read the current stock without aggregating all moves.')
+
+    @classmethod
+    def create(cls, vlist):
+        configurations = super(Configuration, cls).create(vlist)
+        if any('second_quantity_snapshot' in v for v in vlist):
+            cls._synchronize_second_quantity_snapshot()
+        return configurations
+
+    @classmethod
+    def write(cls, *args):
+        super(Configuration, cls).write(*args)
+        actions = iter(args)
+        if any('second_quantity_snapshot' in v
+                for _, v in zip(actions, actions)):
+            cls._synchronize_second_quantity_snapshot()
+
+    @staticmethod
+    def _synchronize_second_quantity_snapshot():
+        Snapshot = Pool().get('stock.second_quantity.snapshot')
+        Snapshot._enabled_cache.clear()
+        if Snapshot.enabled():
+            Snapshot.rebuild()
+        else:
+            Snapshot.clear()
+        products_by_location_cache().clear()
+
+
+class Location:
+    __name__ = 'stock.location'
+
+    @classmethod
+    def write(cls, *args):
+        super(Location, cls).write(*args)
+        actions = iter(args)
+        # The tree and the warehouses change the locations of the quantities
+        fields = set(['parent', 'left', 'right', 'type', 'storage_location',
+                'active'])
+        if any(fields & set(v) for _, v in zip(actions, actions)):
+            products_by_location_cache().clear()
+
+
+class Lot(SecondUomStockMixin):
+    __metaclass__ = PoolMeta
     __name__ = 'stock.lot'
-    use_second_uom = fields.Function(fields.Boolean('Use Second UOM'),
-        'get_use_second_uom', searcher='search_use_second_uom')
+    use_second_uom = fields.Boolean('Use Second UOM', readonly=True,
+        select=True)
+    product_second_uom_category = fields.Many2One('product.uom.category',
+        'Product Second UoM Category', readonly=True, select=True)
     second_uom = fields.Function(fields.Many2One('product.uom', 'Second UoM'),
-        'get_second_uom', searcher='search_second_uom')
+        'get_second_uom_fields', searcher='search_second_uom')
     second_quantity = fields.Function(fields.Float('Second UoM Quantity',
             states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'get_quantity', searcher='search_quantity')
+        'get_quantity', searcher='search_second_quantity')
     second_forecast_quantity = fields.Function(
         fields.Float('Second UoM Forecast Quantity', states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'get_quantity', searcher='search_quantity')
+        'get_quantity', searcher='search_second_quantity')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        fill_second_uom = not table.column_exist(
+            'product_second_uom_category')
+
+        super(Lot, cls).__register__(module_name)
 
-    def get_use_second_uom(self, name=None):
-        return self.product.use_second_uom
+        if fill_second_uom:
+            Product.store_second_uom_values(models=[cls])
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        set_second_uom_values(vlist)
+        return super(Lot, cls).create(vlist)
 
     @classmethod
-    def search_use_second_uom(cls, name, clause):
-        return [('product.use_second_uom', ) + tuple(clause[1:])]
+    def write(cls, *args):
+        super(Lot, cls).write(*set_second_uom_write_values(args))
 
-    def get_second_uom(self, name):
-        if self.product.second_uom:
-            return self.product.second_uom.id
+    @classmethod
+    def get_second_uom_fields(cls, lots, names):
+        Product = Pool().get('product.product')
+        values = Product.get_second_uom_values([l.product.id for l in lots])
+        result = {}
+        for name in names:
+            result[name] = {}
+            if name == 'second_uom':
+                for lot in lots:
+                    result[name][lot.id] = values[lot.product.id][1]
+        return result
 
     @classmethod
     def search_second_uom(cls, name, clause):
         return [('product.second_uom',) + tuple(clause[1:])]
 
+    @classmethod
+    def get_quantity(cls, lots, names):
+        get_quantity = super(Lot, cls).get_quantity
+        if isinstance(names, basestring):
+            return get_quantity(lots, names)
+        location_ids = Transaction().context.get('locations')
+        products = list(set(l.product for l in lots))
+        return cls._get_quantities(lots, names, get_quantity, location_ids,
+            products, grouping=('product', 'lot'))
+
+    @classmethod
+    def search_second_quantity(cls, name, domain=None):
+        location_ids = Transaction().context.get('locations')
+        return cls._search_second_quantity(name, location_ids, domain,
+            grouping=('product', 'lot'))
+
     @classmethod
     def _quantity_context(cls, name):
         if name.startswith('second_'):
@@ -64,11 +750,10 @@ class Lot:
 
 class Move:
     __name__ = 'stock.move'
-    use_second_uom = fields.Function(fields.Boolean('Use Second UoM'),
-        'on_change_with_use_second_uom')
-    product_second_uom_category = fields.Function(
-        fields.Many2One('product.uom.category', 'Product Second UoM Category'),
-        'on_change_with_product_second_uom_category')
+    use_second_uom = fields.Boolean('Use Second UoM', readonly=True,
+        select=True)
+    product_second_uom_category = fields.Many2One('product.uom.category',
+        'Product Second UoM Category', readonly=True, select=True)
     second_uom = fields.Many2One("product.uom", "Second UoM", domain=[
             ('category', '=', Eval('product_second_uom_category')),
             ],
@@ -80,6 +765,7 @@ class Move:
         states=STATES, depends=DEPENDS + ['second_unit_digits'])
     second_internal_quantity = fields.Float('Second Internal Quantity',
         readonly=True)
+    _second_quantity_plans = {}
 
     @classmethod
     def __setup__(cls):
@@ -91,6 +777,21 @@ class Move:
                     'The Second UoM Quantity of move "%s" must be positive.'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        fill_second_uom = not table.column_exist(
+            'product_second_uom_category')
+
+        super(Move, cls).__register__(module_name)
+
+        if fill_second_uom:
+            Product.store_second_uom_values(models=[cls])
+
     @fields.depends('product')
     def on_change_with_use_second_uom(self, name=None):
         if self.product and self.product.use_second_uom:
@@ -123,143 +824,719 @@ class Move:
     @classmethod
     def validate(cls, moves):
         super(Move, cls).validate(moves)
-        for move in moves:
-            move.check_second_uom_required()
-            move.check_second_quantity_positive()
+        cls.check_moves_second_uom_required(moves)
+        cls.check_moves_second_quantity_positive(moves)
+
+    @classmethod
+    def _get_invalid_moves(cls, moves, condition):
+        "Return the moves matching the SQL condition"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        invalid_ids = []
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & condition(table)))
+            invalid_ids.extend(i for i, in cursor.fetchall())
+        return cls.browse(invalid_ids)
 
     def check_second_uom_required(self):
         "Check if second_uom is required"
-        if (self.state == 'done'
-                and self.use_second_uom
-                and (self.second_quantity == None or not self.second_uom
-                    or self.second_internal_quantity == None)):
-            self.raise_user_error('second_uom_required', self.product.rec_name)
+        self.check_moves_second_uom_required([self])
+
+    @classmethod
+    def check_moves_second_uom_required(cls, moves):
+        "Check if second_uom is required for all the moves"
+        invalid_moves = cls._get_invalid_moves(moves,
+            lambda table: (table.state == 'done')
+            & (table.use_second_uom == True)
+            & ((table.second_quantity == None)
+                | (table.second_uom == None)
+                | (table.second_internal_quantity == None)))
+        if invalid_moves:
+            cls.raise_user_error('second_uom_required', '", "'.join(
+                    sorted(set(m.product.rec_name for m in invalid_moves))))
 
     def check_second_quantity_positive(self):
         "Check if second quantities are positive or 0"
-        pool = Pool()
-        InventoryLine = pool.get('stock.inventory.line')
-        if self.origin and isinstance(self.origin, InventoryLine):
-            return
-        if (self.second_quantity and self.second_quantity < 0.
-                or self.second_internal_quantity
-                and self.second_internal_quantity < 0.):
-            self.raise_user_error('second_quantity_not_positive',
-                self.rec_name)
+        self.check_moves_second_quantity_positive([self])
+
+    @classmethod
+    def check_moves_second_quantity_positive(cls, moves):
+        "Check if second quantities are positive or 0 for all the moves"
+        # Inventory moves may have negative second quantities
+        invalid_moves = cls._get_invalid_moves(moves,
+            lambda table: ((table.second_quantity < 0)
+                | (table.second_internal_quantity < 0))
+            & ((table.origin == None)
+                | ~table.origin.like('stock.inventory.line,%')))
+        if invalid_moves:
+            cls.raise_user_error('second_quantity_not_positive',
+                '", "'.join(m.rec_name for m in invalid_moves))
 
     @classmethod
+    @instrumented('Move.compute_quantities_query', rows=None)
     def compute_quantities_query(cls, location_ids, with_childs=False,
             grouping=('product',), grouping_filter=None):
+        '''
+        If the context has second_uom, the quantity column is computed with
+        the second internal quantity. If second_uom is 'both', the quantity
+        column is kept and a last second_quantity column is added.
+        '''
         pool = Pool()
         Period = pool.get('stock.period')
+        Snapshot = pool.get('stock.second_quantity.snapshot')
+
+        second_uom = Transaction().context.get('second_uom')
+        if second_uom and second_uom != 'both':
+            for compute_query in (Snapshot.compute_quantities_query,
+                    Period.compute_second_quantities_query):
+                query = compute_query(location_ids, with_childs=with_childs,
+                    grouping=grouping, grouping_filter=grouping_filter)
+                if query is not None:
+                    return query
 
         query = super(Move, cls).compute_quantities_query(
             location_ids, with_childs=with_childs, grouping=grouping,
             grouping_filter=grouping_filter)
 
-        if query and Transaction().context.get('second_uom'):
-            tables_to_find = [cls._table]
-            for grouping in Period.groupings():
-                Cache = Period.get_cache(grouping)
-                if Cache:
-                    tables_to_find.append(Cache._table)
-
-            def second_qty_column(table):
-                if table._name != cls._table:
-                    return Coalesce(table.second_internal_quantity, Literal(0))
-                return Sum(
-                    Coalesce(table.second_internal_quantity, Literal(0)))
-
-            def find_table(join):
-                if not isinstance(join, Join):
-                    return
-                for pos in ['left', 'right']:
-                    item = getattr(join, pos)
-                    if isinstance(item, Table):
-                        if item._name in tables_to_find:
-                            return getattr(join, pos)
-                    else:
-                        return find_table(item)
-
-            def find_queries(query):
-                if isinstance(query, Union):
-                    for sub_query in query.queries:
-                        for q in find_queries(sub_query):
-                            yield q
-                elif isinstance(query, Select):
-                    yield query
-
-            union, = query.from_
-            for sub_query in find_queries(union):
-                # Find move table
-                for table in sub_query.from_:
-                    if (isinstance(table, Table)
-                            and table._name in tables_to_find):
-                        second_qty_col = second_qty_column(table)
-                        break
-                    found = find_table(table)
-                    if found:
-                        second_qty_col = second_qty_column(found)
-                        break
-                else:
-                    # Not query on move table
-                    continue
-
-                columns = []
-                for col in sub_query.columns:
-                    if col.output_name == 'quantity':
-                        if isinstance(col.expression, Neg):
-                            columns.append(
-                                (-second_qty_col).as_('quantity'))
-                        else:
-                            columns.append(
-                                second_qty_col.as_('quantity'))
-                    else:
-                        columns.append(col)
-                sub_query.columns = tuple(columns)
+        if query and second_uom:
+            cls._set_second_quantity_columns(query, grouping, grouping_filter,
+                both=second_uom == 'both')
         return query
 
     @classmethod
+    def compute_quantities_both(cls, query, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        '''
+        Executes a query of compute_quantities_query with second_uom 'both'
+        in the context like compute_quantities.
+
+        Return two dictionaries with location id and grouping as key and
+            the quantity and the second quantity as value.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        assert query is not None, (
+            "Query in Move.compute_quantities_both() can't be None")
+        assert 'product' in grouping
+
+        cursor = Transaction().cursor
+        cursor.execute(*query)
+
+        product_getter = operator.itemgetter(grouping.index('product') + 1)
+        product_ids = set()
+        quantities = {}
+        second_quantities = {}
+        for line in cursor.fetchall():
+            key = tuple(line[:-2])
+            quantities[key] = line[-2] or 0.0
+            second_quantities[key] = line[-1] or 0.0
+            product_ids.add(product_getter(line))
+
+        # Propagate quantities from child locations to the requested ones
+        if with_childs:
+            parents = dict((l.id, l.parent.id if l.parent else None)
+                for l in Location.search([
+                        ('parent', 'child_of', location_ids),
+                        ]))
+            location_ids = set(location_ids)
+            for values in (quantities, second_quantities):
+                propagated = {}
+                for key, quantity in values.iteritems():
+                    location = key[0]
+                    while location is not None:
+                        if location in location_ids:
+                            parent_key = (location,) + key[1:]
+                            propagated[parent_key] = (
+                                propagated.get(parent_key, 0.0) + quantity)
+                        location = parents.get(location)
+                values.clear()
+                values.update(propagated)
+
+        # Round quantities like compute_quantities does
+        default_uom = dict((p.id, p.default_uom)
+            for p in Product.browse(list(product_ids)))
+        for values in (quantities, second_quantities):
+            for key, quantity in values.iteritems():
+                uom = default_uom[product_getter(key)]
+                values[key] = Uom.round(quantity, uom.rounding)
+        return quantities, second_quantities
+
+    @classmethod
+    def _second_quantity_tables(cls):
+        "Return the names of the tables with a second_internal_quantity"
+        Period = Pool().get('stock.period')
+        tables = set([cls._table])
+        for grouping in Period.groupings():
+            Cache = Period.get_cache(grouping)
+            if Cache:
+                tables.add(Cache._table)
+        return frozenset(tables)
+
+    @classmethod
+    def _set_second_quantity_columns(cls, query, grouping, grouping_filter,
+            both=False):
+        """
+        Replace the quantity columns of the sub-queries of query computed by
+        compute_quantities_query by the second internal quantity or, if both,
+        add the second internal quantity column after them.
+        The positions of the columns to replace are computed once for each
+        database and grouping and stored as a plan.
+        """
+        tables = cls._second_quantity_tables()
+        union, = query.from_
+        key = (Transaction().cursor.dbname, tuple(grouping),
+            bool(grouping_filter and any(grouping_filter)), tables)
+        plan = cls._second_quantity_plans.get(key)
+        resolved = plan is not None and _resolve_quantity_plan(
+            union, plan, tables)
+        if not resolved:
+            plan = _quantity_plan(union, tables)
+            cls._second_quantity_plans[key] = plan
+            resolved = _resolve_quantity_plan(union, plan, tables)
+
+        for sub_query, table, index, negative in resolved:
+            column = Coalesce(table.second_internal_quantity, Literal(0))
+            if table._name == cls._table:
+                column = Sum(column)
+            if negative:
+                column = -column
+            columns = list(sub_query.columns)
+            if both:
+                columns.insert(index + 1, column.as_('second_quantity'))
+            else:
+                columns[index] = column.as_('quantity')
+            sub_query.columns = tuple(columns)
+        if both:
+            query.columns += (
+                Sum(union.second_quantity).as_('second_quantity'),)
+
+    @classmethod
+    @instrumented('Move.create')
     def create(cls, vlist):
         pool = Pool()
         Product = pool.get('product.product')
         Uom = pool.get('product.uom')
+        Snapshot = pool.get('stock.second_quantity.snapshot')
 
+        products_by_location_cache().clear()
         vlist = [x.copy() for x in vlist]
-        for vals in vlist:
-            product = Product(vals['product'])
-            if vals.get('second_uom') and vals.get('second_quantity'):
-                second_uom = Uom(vals['second_uom'])
-                second_internal_quantity = cls._get_second_internal_quantity(
-                    vals['second_quantity'], second_uom, product)
-                vals['second_internal_quantity'] = second_internal_quantity
-        return super(Move, cls).create(vlist)
+        set_second_uom_values(vlist)
+        to_compute = [v for v in vlist
+            if v.get('second_uom') and v.get('second_quantity')]
+        if to_compute:
+            # Browse all products and uoms at once to share the read cache
+            products = dict((p.id, p) for p in Product.browse(
+                    list(set(v['product'] for v in to_compute))))
+            uoms = dict((u.id, u) for u in Uom.browse(
+                    list(set(v['second_uom'] for v in to_compute))))
+            quantities = cls._get_second_internal_quantities(
+                [(v['second_quantity'], uoms[v['second_uom']],
+                        products[v['product']]) for v in to_compute])
+            for vals, quantity in zip(to_compute, quantities):
+                vals['second_internal_quantity'] = quantity
+        moves = super(Move, cls).create(vlist)
+
+        done_ids = [m.id for m, v in zip(moves, vlist)
+            if v.get('state') == 'done']
+        if done_ids and Snapshot.enabled():
+            Snapshot.update_moves({}, Snapshot.get_move_values(done_ids))
+        return moves
 
     @classmethod
+    @instrumented('Move.write', rows=_write_rows)
     def write(cls, *args):
-        super(Move, cls).write(*args)
+        pool = Pool()
+        Snapshot = pool.get('stock.second_quantity.snapshot')
 
+        products_by_location_cache().clear()
+        args = set_second_uom_write_values(args)
         actions = iter(args)
+        move_ids = set()
+        snapshot_ids = set()
         for moves, values in zip(actions, actions):
-            for move in moves:
-                if not move.second_uom or move.second_quantity == None:
-                    continue
-                second_internal_qty = cls._get_second_internal_quantity(
-                    move.second_quantity, move.second_uom, move.product)
-                if (second_internal_qty != move.second_internal_quantity
-                        and second_internal_qty
-                        != values.get('second_nternal_quantity')):
-                    cls.write([move], {
-                            'second_internal_quantity': second_internal_qty,
-                            })
+            if set(values) & cls._second_internal_quantity_fields():
+                move_ids.update(m.id for m in moves)
+            if set(values) & Snapshot.move_fields():
+                snapshot_ids.update(m.id for m in moves)
+        if snapshot_ids and Snapshot.enabled():
+            old_values = Snapshot.get_move_values(list(snapshot_ids))
+        else:
+            snapshot_ids = None
+
+        super(Move, cls).write(*args)
+
+        if move_ids:
+            cls._update_second_internal_quantity(cls.browse(list(move_ids)))
+        if snapshot_ids:
+            Snapshot.update_moves(old_values,
+                Snapshot.get_move_values(list(snapshot_ids)))
+
+    @classmethod
+    def delete(cls, moves):
+        products_by_location_cache().clear()
+        super(Move, cls).delete(moves)
+
+    @classmethod
+    def _update_second_internal_quantity(cls, moves):
+        "Store the second internal quantity of moves if it has changed"
+        moves = [m for m in moves
+            if m.second_uom and m.second_quantity is not None]
+        quantities = cls._get_second_internal_quantities(
+            [(m.second_quantity, m.second_uom, m.product) for m in moves])
+        moves_by_quantity = {}
+        for move, quantity in zip(moves, quantities):
+            if quantity != move.second_internal_quantity:
+                moves_by_quantity.setdefault(quantity, []).append(move)
+        to_write = []
+        for quantity, moves in moves_by_quantity.iteritems():
+            to_write.extend((moves, {
+                        'second_internal_quantity': quantity,
+                        }))
+        if to_write:
+            super(Move, cls).write(*to_write)
+
+    @classmethod
+    def recompute_second_internal_quantities(cls, product_ids, start_id=0,
+            commit=False):
+        """
+        Recompute the second internal quantity of the moves of the products
+        like _update_second_internal_quantity, for example after their second
+        UoM changed. See check_second_internal_quantities for start_id and
+        commit.
+
+        Return the number of updated moves.
+        """
+        return cls.check_second_internal_quantities(product_ids,
+            repair=True, start_id=start_id, commit=commit)['repaired']
+
+    @classmethod
+    def check_second_internal_quantities(cls, product_ids=None, repair=False,
+            start_id=0, commit=False):
+        """
+        Check the stored second internal quantity of the moves (of the
+        products if product_ids is not None) against the one computed like
+        _update_second_internal_quantity and, if repair, update the
+        mismatching ones.
+
+        The moves are read by chunks ordered by id from start_id and each
+        distinct conversion of a chunk is computed once. The repaired moves
+        are updated with one query by quantity. The progress is logged after
+        each chunk and, if commit, the transaction is committed so an
+        interrupted run can be resumed from the last logged id.
+
+        Return a dictionary with the number of checked, mismatching and
+        repaired moves, the last id, the duration and the moves by second.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Snapshot = pool.get('stock.second_quantity.snapshot')
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        snapshot = repair and Snapshot.enabled()
+        where = (table.second_uom != None) & (table.second_quantity != None)
+        if product_ids is not None:
+            where &= reduce_ids(table.product, product_ids)
+        report = {
+            'checked': 0,
+            'mismatches': 0,
+            'repaired': 0,
+            'last_id': start_id,
+            }
+        start = time.time()
+        while True:
+            cursor.execute(*table.select(table.id, table.product,
+                    table.second_uom, table.second_quantity,
+                    table.second_internal_quantity,
+                    where=where & (table.id > report['last_id']),
+                    order_by=[table.id.asc],
+                    limit=cls._recompute_chunk_size()))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            report['last_id'] = rows[-1][0]
+            report['checked'] += len(rows)
+
+            products = dict((p.id, p) for p in Product.browse(
+                    list(set(r[1] for r in rows))))
+            uoms = dict((u.id, u) for u in Uom.browse(
+                    list(set(r[2] for r in rows))))
+            quantities = cls._get_second_internal_quantities(
+                [(r[3], uoms[r[2]], products[r[1]]) for r in rows])
+            ids_by_quantity = {}
+            for row, quantity in zip(rows, quantities):
+                if quantity != row[4]:
+                    ids_by_quantity.setdefault(quantity, []).append(row[0])
+            move_ids = [i for ids in ids_by_quantity.itervalues()
+                for i in ids]
+            report['mismatches'] += len(move_ids)
+
+            if repair and move_ids:
+                if snapshot:
+                    old_values = Snapshot.get_move_values(move_ids)
+                for quantity, ids in ids_by_quantity.iteritems():
+                    for sub_ids in grouped_slice(ids):
+                        cursor.execute(*table.update(
+                                [table.second_internal_quantity], [quantity],
+                                where=reduce_ids(table.id, sub_ids)))
+                if snapshot:
+                    Snapshot.update_moves(old_values,
+                        Snapshot.get_move_values(move_ids))
+                report['repaired'] += len(move_ids)
+                if commit:
+                    cursor.commit()
+
+            report['duration'] = time.time() - start
+            logger.info('checked second internal quantities of %(checked)s '
+                'moves up to id %(last_id)s: %(mismatches)s mismatches, '
+                '%(repaired)s repaired, %(rate).0f moves/s',
+                dict(report, rate=report['checked'] / report['duration']
+                    if report['duration'] else 0))
+        if report['repaired']:
+            products_by_location_cache().clear()
+        report['duration'] = time.time() - start
+        report['rate'] = (report['checked'] / report['duration']
+            if report['duration'] else 0.)
+        return report
+
+    @staticmethod
+    def _recompute_chunk_size():
+        "Return the number of moves recomputed at once"
+        return 10 * Transaction().cursor.IN_MAX
+
+    @staticmethod
+    def _second_internal_quantity_fields():
+        "Return the fields that second_internal_quantity depends on"
+        return set(['product', 'second_uom', 'second_quantity',
+                'second_internal_quantity'])
 
     @staticmethod
     def _get_second_internal_quantity(quantity, uom, product):
         Uom = Pool().get('product.uom')
         if product.second_uom:
-            return Uom.compute_qty(uom, quantity,
+            return Uom.compute_qty_cached(uom, quantity,
                 product.second_uom, round=True)
 
+    @classmethod
+    def _get_second_internal_quantities(cls, items):
+        """
+        Return the second internal quantities for a list of
+        (quantity, uom, product) tuples.
+        Each distinct conversion (uom, product second uom, quantity) is
+        computed only once.
+        """
+        computed = {}
+        quantities = []
+        for quantity, uom, product in items:
+            key = (uom.id,
+                product.second_uom.id if product.second_uom else None,
+                quantity)
+            if key not in computed:
+                computed[key] = cls._get_second_internal_quantity(
+                    quantity, uom, product)
+            quantities.append(computed[key])
+        return quantities
+
+
+class SecondQuantitySnapshot(ModelSQL):
+    """
+    Stock Second Quantity Snapshot
+
+    Second internal quantity of the done moves by company, location and
+    product. It is maintained incrementally by Move.create and Move.write when
+    the snapshot is activated on the stock configuration.
+    """
+    __name__ = 'stock.second_quantity.snapshot'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    second_internal_quantity = fields.Float('Second Internal Quantity',
+        readonly=True)
+    _enabled_cache = Cache('stock.second_quantity.snapshot.enabled',
+        context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(SecondQuantitySnapshot, cls).__setup__()
+        cls._sql_constraints += [
+            ('key_uniq', 'UNIQUE(company, location, product)',
+                'The snapshot key must be unique.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        rebuild = False
+        if TableHandler.table_exist(cursor, cls._table):
+            handler = TableHandler(cursor, cls, module_name)
+            # Migration from snapshot without company or by lot: compute it
+            # again
+            if (not handler.column_exist('company')
+                    or handler.column_exist('lot')):
+                cursor.execute(*table.select(table.id, limit=1))
+                rebuild = bool(cursor.fetchall())
+                cls.clear()
+                handler.drop_constraint('key_uniq')
+                handler.drop_column('lot')
+
+        super(SecondQuantitySnapshot, cls).__register__(module_name)
+
+        if rebuild:
+            cls.rebuild()
+
+    @classmethod
+    def enabled(cls):
+        enabled = cls._enabled_cache.get(None)
+        if enabled is None:
+            Configuration = Pool().get('stock.configuration')
+            enabled = bool(Configuration(1).second_quantity_snapshot)
+            cls._enabled_cache.set(None, enabled)
+        return enabled
+
+    @staticmethod
+    def move_fields():
+        "Return the move fields that change the snapshot"
+        return set(['state', 'company', 'from_location', 'to_location',
+                'product', 'second_uom', 'second_quantity',
+                'second_internal_quantity'])
+
+    @classmethod
+    def clear(cls):
+        table = cls.__table__()
+        Transaction().cursor.execute(*table.delete())
+
+    @classmethod
+    def rebuild(cls):
+        "Recompute the whole snapshot from the done moves"
+        pool = Pool()
+        Move = pool.get('stock.move')
+        table = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().cursor
+
+        cls.clear()
+        quantity = Coalesce(move.second_internal_quantity, Literal(0))
+        done = move.state == 'done'
+        union = Union(
+            move.select(move.company.as_('company'),
+                move.to_location.as_('location'),
+                move.product.as_('product'),
+                quantity.as_('quantity'), where=done),
+            move.select(move.company.as_('company'),
+                move.from_location.as_('location'),
+                move.product.as_('product'),
+                (-quantity).as_('quantity'), where=done),
+            all_=True)
+        keys = [union.company, union.location, union.product]
+        cursor.execute(*table.insert(
+                [table.company, table.location, table.product,
+                    table.second_internal_quantity],
+                union.select(*(keys + [Sum(union.quantity)]),
+                    group_by=keys)))
+
+    @classmethod
+    def get_move_values(cls, move_ids):
+        """
+        Return a dictionary with the id of the done moves as key and a tuple
+        (company, from_location, to_location, product,
+        second_internal_quantity) as value.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().cursor
+
+        values = {}
+        for sub_ids in grouped_slice(move_ids):
+            cursor.execute(*move.select(move.id, move.company,
+                    move.from_location, move.to_location, move.product,
+                    move.second_internal_quantity,
+                    where=reduce_ids(move.id, sub_ids)
+                    & (move.state == 'done')))
+            for row in cursor.fetchall():
+                values[row[0]] = tuple(row[1:])
+        return values
+
+    @classmethod
+    def update_moves(cls, old_values, new_values):
+        """
+        Update the snapshot from the values of get_move_values before and
+        after the moves changed.
+        """
+        deltas = {}
+        for values, sign in ((old_values, -1), (new_values, 1)):
+            for (company, from_location, to_location, product,
+                    quantity) in values.itervalues():
+                if not quantity:
+                    continue
+                for location, factor in ((to_location, 1),
+                        (from_location, -1)):
+                    key = (company, location, product)
+                    deltas[key] = (deltas.get(key, 0)
+                        + sign * factor * quantity)
+        cls._apply_deltas(dict((k, v) for k, v in deltas.iteritems() if v))
+
+    @classmethod
+    def _apply_deltas(cls, deltas):
+        """
+        Add the deltas to the existing rows of the snapshot and insert the
+        missing keys. Concurrent inserts of the same key are refused by the
+        unique constraint.
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        if not deltas:
+            return
+
+        existing = {}
+        product_ids = sorted(set(k[2] for k in deltas))
+        location_ids = sorted(set(k[1] for k in deltas))
+        for sub_ids in grouped_slice(product_ids):
+            cursor.execute(*table.select(table.id, table.company,
+                    table.location, table.product,
+                    where=reduce_ids(table.product, sub_ids)
+                    & table.location.in_(location_ids)))
+            for row in cursor.fetchall():
+                if tuple(row[1:]) in deltas:
+                    existing[tuple(row[1:])] = row[0]
+
+        to_update = sorted((i, deltas[k]) for k, i in existing.iteritems())
+        for sub_values in grouped_slice(to_update):
+            sub_values = list(sub_values)
+            cursor.execute(*table.update([table.second_internal_quantity],
+                    [table.second_internal_quantity + Case(
+                            *[(table.id == i, d) for i, d in sub_values])],
+                    where=reduce_ids(table.id, [i for i, _ in sub_values])))
+
+        to_insert = [list(k) + [d] for k, d in sorted(deltas.iteritems())
+            if k not in existing]
+        for sub_values in grouped_slice(to_insert):
+            cursor.execute(*table.insert([table.company, table.location,
+                        table.product, table.second_internal_quantity],
+                    list(sub_values)))
+
+    @classmethod
+    def _has_future_moves(cls, company_id):
+        """
+        Tell if there are done moves of the company that the current stock
+        would not count because their date is in the future.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Move = pool.get('stock.move')
+        move = Move.__table__()
+        cursor = Transaction().cursor
+
+        today = Date.today()
+        where = ((move.state == 'done')
+            & ((move.effective_date > today)
+                | ((move.effective_date == None)
+                    & ((move.planned_date == None)
+                        | (move.planned_date > today)))))
+        if company_id is not None:
+            where &= move.company == company_id
+        cursor.execute(*move.select(move.id, where=where, limit=1))
+        return bool(cursor.fetchall())
+
+    @staticmethod
+    def _has_other_move_rules():
+        "Tell if stock.move has other rules than the company rule of stock"
+        pool = Pool()
+        Rule = pool.get('ir.rule')
+        ModelData = pool.get('ir.model.data')
+
+        company_rule = ModelData.get_id('stock', 'rule_move')
+        with Transaction().set_user(0):
+            rules = Rule.search([
+                    ('rule_group.model.model', '=', 'stock.move'),
+                    ('rule_group.perm_read', '=', True),
+                    ('id', '!=', company_rule),
+                    ], limit=1)
+        return bool(rules)
+
+    @classmethod
+    def compute_quantities_query(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        """
+        Return a query with the same columns as Move.compute_quantities_query
+        computing the second quantities from the snapshot or None if the
+        snapshot can not be used for the context.
+
+        Only the current stock by product (stock_date_end is today without
+        forecast, assignation, start date nor destinations) is supported.
+        The snapshot is not used when there are done moves dated in the
+        future or when stock.move has other rules than the company rule,
+        which is applied by filtering on the company of the user.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        User = pool.get('res.user')
+        transaction = Transaction()
+        context = transaction.context
+
+        if (not location_ids
+                or grouping != ('product',)
+                or context.get('stock_date_end') != Date.today()
+                or context.get('stock_date_start')
+                or context.get('forecast')
+                or context.get('stock_assign')
+                or context.get('stock_destinations')
+                or not cls.enabled()):
+            return None
+
+        table = cls.__table__()
+        where = Literal(True)
+        company_id = None
+        if transaction.user != 0:
+            company = User(transaction.user).company
+            if not company:
+                return None
+            company_id = company.id
+            where &= table.company == company_id
+        if cls._has_future_moves(company_id) or cls._has_other_move_rules():
+            return None
+        product = Product.__table__()
+        template = Template.__table__()
+
+        if with_childs:
+            location_query = Location.search([
+                    ('parent', 'child_of', location_ids),
+                    ], query=True, order=[])
+        else:
+            location_query = location_ids[:]
+        where &= table.location.in_(location_query)
+
+        from_ = table
+        if grouping_filter and grouping_filter[0]:
+            where &= reduce_ids(table.product, grouping_filter[0])
+        else:
+            from_ = from_.join(product,
+                condition=table.product == product.id)
+            from_ = from_.join(template,
+                condition=product.template == template.id)
+            where &= template.active == True
+
+        return from_.select(table.location.as_('location'),
+            table.product.as_('product'),
+            Sum(table.second_internal_quantity).as_('quantity'),
+            where=where,
+            group_by=[table.location, table.product])
+
 
 class ShipmentIn:
     __name__ = 'stock.shipment.in'
@@ -284,31 +1561,77 @@ class ShipmentOut:
         return inventory_move
 
     @classmethod
+    @instrumented('ShipmentOut._sync_inventory_to_outgoing')
     def _sync_inventory_to_outgoing(cls, shipments):
         pool = Pool()
-        Uom = pool.get('product.uom')
+        Move = pool.get('stock.move')
         super(ShipmentOut, cls)._sync_inventory_to_outgoing(shipments)
+        to_write = []
         for shipment in shipments:
             outgoing_by_product = {}
             for move in shipment.outgoing_moves:
-                if not move.use_second_uom:
+                if not move.use_second_uom or move.state == 'cancel':
                     continue
                 outgoing_by_product.setdefault(move.product.id,
                     []).append(move)
+            # Sum the inventory second quantities by product and second UoM
+            inventory_by_product = {}
             for move in shipment.inventory_moves:
-                if not move.use_second_uom:
+                if not move.use_second_uom or move.state == 'cancel':
                     continue
-                out_move = outgoing_by_product[move.product.id][0]
-                if out_move.second_uom and out_move.second_quantity:
-                    out_move.second_quantity += Uom.compute_qty(
-                        move.second_uom,
-                        move.second_quantity,
-                        out_move.second_uom)
-                    out_move.save()
-                else:
-                    out_move.second_quantity = move.second_quantity
-                    out_move.second_uom = move.second_uom
-                    out_move.save()
+                quantities = inventory_by_product.setdefault(move.product.id,
+                    OrderedDict())
+                quantities.setdefault(move.second_uom, 0.)
+                quantities[move.second_uom] += move.second_quantity or 0.
+            for product_id, quantities in inventory_by_product.iteritems():
+                if product_id not in outgoing_by_product:
+                    continue
+                to_write.extend(cls._get_outgoing_second_quantities(
+                        outgoing_by_product[product_id], quantities))
+        if to_write:
+            Move.write(*to_write)
+
+    @staticmethod
+    def _get_outgoing_second_quantities(moves, quantities):
+        '''
+        Return the write arguments adding the inventory quantities, a
+        dictionary of second quantity by second UoM, to the outgoing moves of
+        a product. The quantities are shared in proportion to the quantity of
+        each move and rounded in the second UoM of the move, the last move
+        getting the remainder so the total is kept.
+        '''
+        Uom = Pool().get('product.uom')
+        second_uom = moves[0].product.second_uom
+        quantity = sum(Uom.compute_qty_cached(uom, qty, second_uom,
+                round=False) for uom, qty in quantities.iteritems())
+        total = sum(m.internal_quantity or 0. for m in moves)
+        inventory_uom = quantities.keys()[0]
+
+        to_write = []
+        remainder = quantity
+        for i, move in enumerate(moves):
+            if i == len(moves) - 1:
+                share = remainder
+            elif total:
+                share = quantity * (move.internal_quantity or 0.) / total
+            else:
+                share = quantity / len(moves)
+            add = bool(move.second_uom and move.second_quantity)
+            uom = move.second_uom if add else inventory_uom
+            share = Uom.compute_qty_cached(second_uom, share, uom)
+            remainder -= Uom.compute_qty_cached(uom, share, second_uom,
+                round=False)
+            if add:
+                values = {
+                    'second_quantity': move.second_quantity + share,
+                    }
+            else:
+                values = {
+                    'second_quantity': share,
+                    'second_uom': uom.id,
+                    }
+            to_write.extend(([move], values))
+        return to_write
 
 
 class ShipmentOutReturn:
@@ -324,41 +1647,286 @@ class ShipmentOutReturn:
         return move
 
 
-class PeriodCache:
-    __name__ = 'stock.period.cache'
-    second_internal_quantity = fields.Float('Second Internal Quantity',
-        readonly=True)
+class Period:
+    __name__ = 'stock.period'
 
     @classmethod
-    def create(cls, vlist):
-        pool = Pool()
-        Period = pool.get('stock.period')
-        Product = pool.get('product.product')
+    def close(cls, periods):
+        # Let products_by_location compute the second quantities with the
+        # quantities of the caches
+        with Transaction().set_context(_second_uom_period_close=True):
+            super(Period, cls).close(periods)
+        products_by_location_cache().clear()
+
+    @classmethod
+    def draft(cls, periods):
+        super(Period, cls).draft(periods)
+        products_by_location_cache().clear()
 
-        vlist_by_period_location = {}
-        for values in vlist:
-            vlist_by_period_location.setdefault(values['period'], {})\
-                .setdefault(values['location'], []).append(values)
+    @classmethod
+    def recompute_second_internal_quantities(cls, product_ids, commit=False):
+        """
+        Recompute the second internal quantity of the caches of the closed
+        periods for the products from the second internal quantities of the
+        done moves, with one update query by period, cache and chunk of
+        products.
+        If commit, the transaction is committed after each period.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        cursor = Transaction().cursor
+
+        periods = cls.search([
+                ('state', '=', 'closed'),
+                ], order=[('date', 'ASC')])
+        for period in periods:
+            for grouping in cls.groupings():
+                Cache = cls.get_cache(grouping)
+                if not Cache:
+                    continue
+                cache = Cache.__table__()
+                move = Move.__table__()
+                where = ((move.state == 'done')
+                    & (move.effective_date <= period.date))
+                for fname in grouping:
+                    move_column = Column(move, fname)
+                    cache_column = Column(cache, fname)
+                    where &= ((move_column == cache_column)
+                        | ((move_column == None) & (cache_column == None)))
+                quantity = Coalesce(move.second_internal_quantity, Literal(0))
+                union = Union(
+                    move.select(quantity.as_('quantity'),
+                        where=where & (move.to_location == cache.location)),
+                    move.select((-quantity).as_('quantity'),
+                        where=where & (move.from_location == cache.location)),
+                    all_=True)
+                total = union.select(
+                    Coalesce(Sum(union.quantity), Literal(0)))
+                for sub_ids in grouped_slice(product_ids):
+                    cursor.execute(*cache.update(
+                            [cache.second_internal_quantity], [total],
+                            where=(cache.period == period.id)
+                            & reduce_ids(cache.product, sub_ids)))
+            if commit:
+                cursor.commit()
+            logger.info('recomputed second internal quantities of period %s',
+                period.id)
 
-        vlist = []
-        for period_id, vlist_by_location in \
-                vlist_by_period_location.iteritems():
-            period = Period(period_id)
+    @classmethod
+    def compute_second_quantities_query(cls, location_ids, with_childs=False,
+            grouping=('product',), grouping_filter=None):
+        """
+        Return a query with the same columns as Move.compute_quantities_query
+        computing the second quantities at stock_date_end backward from the
+        cache of the next closed period or None if the previous closed period
+        is closer or the context is not supported.
+
+        Only past dates without start date, assignation, forecast nor
+        destinations are supported.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Rule = pool.get('ir.rule')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        context = Transaction().context
+
+        date = context.get('stock_date_end')
+        PeriodCache = cls.get_cache(grouping)
+        if (not location_ids
+                or not PeriodCache
+                or not date
+                or date >= Date.today()
+                or context.get('stock_date_start')
+                or context.get('stock_assign')
+                or context.get('forecast')
+                or context.get('stock_destinations')):
+            return None
+
+        next_periods = cls.search([
+                ('date', '>=', date),
+                ('state', '=', 'closed'),
+                ], order=[('date', 'ASC')], limit=1)
+        if not next_periods:
+            return None
+        next_period, = next_periods
+        previous_periods = cls.search([
+                ('date', '<', date),
+                ('state', '=', 'closed'),
+                ], order=[('date', 'DESC')], limit=1)
+        # Use the number of days as estimation of the number of moves
+        if (previous_periods
+                and (date - previous_periods[0].date
+                    <= next_period.date - date)):
+            return None
+
+        move = Move.__table__()
+        period_cache = PeriodCache.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        if with_childs:
+            location_query = Location.search([
+                    ('parent', 'child_of', location_ids),
+                    ], query=True, order=[])
+        else:
+            location_query = location_ids[:]
+
+        from_ = move
+        from_period = period_cache
+        if grouping_filter and any(grouping_filter):
+            where = where_period = Literal(True)
+            for fieldname, grouping_ids in zip(grouping, grouping_filter):
+                if not grouping_ids:
+                    continue
+                column = Column(move, fieldname)
+                cache_column = Column(period_cache, fieldname)
+                if isinstance(grouping_ids[0], (int, long)):
+                    where &= reduce_ids(column, grouping_ids)
+                    where_period &= reduce_ids(cache_column, grouping_ids)
+                else:
+                    where &= column.in_(grouping_ids)
+                    where_period &= cache_column.in_(grouping_ids)
+        else:
+            where = where_period = template.active == True
+            from_ = from_.join(product, condition=move.product == product.id)
+            from_ = from_.join(template,
+                condition=product.template == template.id)
+            from_period = from_period.join(product,
+                condition=period_cache.product == product.id)
+            from_period = from_period.join(template,
+                condition=product.template == template.id)
+
+        # The moves between the date and the closed period are all done
+        move_date = Coalesce(move.effective_date, move.planned_date)
+        where &= ((move.state == 'done')
+            & (move_date > date)
+            & (move_date <= next_period.date))
+        move_rule_query = Rule.domain_get('stock.move')
+        if move_rule_query:
+            where &= move.id.in_(move_rule_query)
+        quantity = Sum(Coalesce(move.second_internal_quantity, Literal(0)))
+
+        move_keys = [Column(move, key).as_(key) for key in grouping]
+        period_keys = [Column(period_cache, key).as_(key) for key in grouping]
+        query = Union(
+            from_.select(move.to_location.as_('location'),
+                (-quantity).as_('quantity'),
+                *move_keys,
+                where=where & move.to_location.in_(location_query),
+                group_by=[move.to_location] + move_keys),
+            from_.select(move.from_location.as_('location'),
+                quantity.as_('quantity'),
+                *move_keys,
+                where=where & move.from_location.in_(location_query),
+                group_by=[move.from_location] + move_keys),
+            from_period.select(period_cache.location.as_('location'),
+                Coalesce(period_cache.second_internal_quantity,
+                    Literal(0)).as_('quantity'),
+                *period_keys,
+                where=(period_cache.period == next_period.id)
+                & where_period
+                & period_cache.location.in_(location_query)),
+            all_=True)
+        query_keys = [Column(query, key).as_(key) for key in grouping]
+        return query.select(query.location.as_('location'),
+            *(query_keys + [Sum(query.quantity).as_('quantity')]),
+            group_by=[query.location] + query_keys)
+
+
+def period_second_quantities():
+    """
+    Return the dictionary of the second quantities computed while closing
+    periods with the key of period_second_quantities_key.
+    """
+    return transaction_cache('period_second_quantities')
+
+
+def period_second_quantities_key(grouping, date, location_ids, product_ids):
+    """
+    Return the key of the second quantities computed for the company of the
+    user, the grouping and the date, restricted to the locations and to the
+    products (None for all the products).
+    """
+    User = Pool().get('res.user')
+    company = User(Transaction().user).company
+    if product_ids is not None:
+        product_ids = frozenset(product_ids)
+    return (company.id if company else None, tuple(grouping), date,
+        frozenset(location_ids), product_ids)
+
+
+def pop_period_second_quantities(grouping, date, location_ids,
+        product_ids):
+    """
+    Remove and return the second quantities computed while closing periods
+    which include the locations and products or None if there is not.
+    """
+    quantities = period_second_quantities()
+    company, grouping, date, location_ids, product_ids = (
+        period_second_quantities_key(grouping, date, location_ids,
+            product_ids))
+    for key in quantities.keys():
+        key_company, key_grouping, key_date, key_locations, key_products = key
+        if (key_company == company
+                and key_grouping == grouping
+                and key_date == date
+                and key_locations >= location_ids
+                and (key_products is None
+                    or (product_ids is not None
+                        and key_products >= product_ids))):
+            return quantities.pop(key)
+
+
+def _set_period_cache_second_quantity(vlist, grouping):
+    "Set second_internal_quantity of period cache values"
+    pool = Pool()
+    Period = pool.get('stock.period')
+    Product = pool.get('product.product')
+
+    vlist_by_period_location = {}
+    for values in vlist:
+        if 'second_internal_quantity' in values:
+            continue
+        vlist_by_period_location.setdefault(values['period'], {})\
+            .setdefault(values['location'], []).append(values)
+
+    for period_id, vlist_by_location in \
+            vlist_by_period_location.iteritems():
+        period = Period(period_id)
+        product_ids = set(values['product']
+            for location_vlist in vlist_by_location.itervalues()
+            for values in location_vlist)
+        pbl = pop_period_second_quantities(grouping, period.date,
+            vlist_by_location.keys(), product_ids)
+        if pbl is None:
             with Transaction().set_context(
                     stock_date_end=period.date,
                     stock_date_start=None,
                     stock_assign=False,
                     forecast=False,
                     stock_destinations=None,
-                    second_uom=True,
                     ):
-                pbl = Product.products_by_location(
-                    vlist_by_location.keys(), grouping=('product',))
-            for location_id, location_vlist in vlist_by_location.iteritems():
-                for values in location_vlist:
-                    key = (location_id, values['product'])
-                    values['second_internal_quantity'] = pbl.get(key, 0.0)
-                    vlist.append(values)
+                pbl = Product.products_by_location_compact(
+                    vlist_by_location.keys(), grouping=grouping)
+        for location_id, location_vlist in vlist_by_location.iteritems():
+            for values in location_vlist:
+                key = (location_id,) + tuple(values[f] for f in grouping)
+                values['second_internal_quantity'] = pbl.get(key, 0.0)
+
+
+class PeriodCache:
+    __name__ = 'stock.period.cache'
+    second_internal_quantity = fields.Float('Second Internal Quantity',
+        readonly=True)
+
+    @classmethod
+    @instrumented('PeriodCache.create')
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        _set_period_cache_second_quantity(vlist, ('product',))
         return super(PeriodCache, cls).create(vlist)
 
 
@@ -368,35 +1936,10 @@ class PeriodCacheLot:
         readonly=True)
 
     @classmethod
+    @instrumented('PeriodCacheLot.create')
     def create(cls, vlist):
-        pool = Pool()
-        Period = pool.get('stock.period')
-        Product = pool.get('product.product')
-
-        vlist_by_period_location = {}
-        for values in vlist:
-            vlist_by_period_location.setdefault(values['period'], {})\
-                .setdefault(values['location'], []).append(values)
-
-        vlist = []
-        for period_id, vlist_by_location in \
-                vlist_by_period_location.iteritems():
-            period = Period(period_id)
-            with Transaction().set_context(
-                    stock_date_end=period.date,
-                    stock_date_start=None,
-                    stock_assign=False,
-                    forecast=False,
-                    stock_destinations=None,
-                    second_uom=True,
-                    ):
-                pbl = Product.products_by_location(
-                    vlist_by_location.keys(), grouping=('product', 'lot'))
-            for location_id, location_vlist in vlist_by_location.iteritems():
-                for values in location_vlist:
-                    key = (location_id, values['product'], values['lot'])
-                    values['second_internal_quantity'] = pbl.get(key, 0.0)
-                    vlist.append(values)
+        vlist = [x.copy() for x in vlist]
+        _set_period_cache_second_quantity(vlist, ('product', 'lot'))
         return super(PeriodCacheLot, cls).create(vlist)
 
 
@@ -404,69 +1947,81 @@ class Inventory:
     __name__ = 'stock.inventory'
 
     @classmethod
-    def complete_lines(cls, inventories):
-        pool = Pool()
-        Line = pool.get('stock.inventory.line')
-        Product = pool.get('product.product')
+    def confirm(cls, inventories):
+        Line = Pool().get('stock.inventory.line')
+        lines = [l for i in inventories for l in i.lines]
+        with Line.prepare_moves_values(lines):
+            super(Inventory, cls).confirm(inventories)
 
+    @classmethod
+    @instrumented('Inventory.complete_lines')
+    def complete_lines(cls, inventories):
         super(Inventory, cls).complete_lines(inventories)
 
         grouping = cls.grouping()
-        to_create = []
         for inventory in inventories:
-            # Compute product second quantities
-            with Transaction().set_context(
-                    stock_date_end=inventory.date,
-                    second_uom=True):
-                pbl = Product.products_by_location(
-                    [inventory.location.id], grouping=grouping)
-
-            # Index some data
-            product2type = {}
-            product2consumable = {}
-            for product in Product.browse([line[1] for line in pbl]):
-                if not product.use_second_uom:
-                    continue
-                product2type[product.id] = product.type
-                product2consumable[product.id] = product.consumable
+            cls._complete_second_uom_lines(inventory, grouping)
 
-            # Update existing lines
-            to_write = []
-            for line in inventory.lines:
-                if not line.product.use_second_uom:
-                    continue
-                key = (inventory.location.id,) + line.unique_key
-                if key in pbl:
-                    second_qty = pbl.pop(key)
-                else:
-                    second_qty = 0.0
-                if (line.second_quantity == line.second_expected_quantity
-                            == second_qty):
-                    continue
-                values = {
-                    'second_expected_quantity': second_qty,
-                    }
-                if line.second_quantity == line.second_expected_quantity:
-                    values['second_quantity'] = max(second_qty, 0.0)
-                to_write.extend(([line], values))
-            if to_write:
-                Line.write(*to_write)
-
-            # Create lines if needed
-            for key, second_qty in pbl.iteritems():
-                product_id = key[grouping.index('product') + 1]
-                if not second_qty:
-                    continue
-                if (product2type[product_id] != 'goods'
-                        or product2consumable[product_id]):
-                    continue
+    @classmethod
+    def _complete_second_uom_lines(cls, inventory, grouping):
+        """
+        Complete or update the second quantities of inventory for the
+        products using the second UoM with moves in its location
+        """
+        pool = Pool()
+        Line = pool.get('stock.inventory.line')
+        Product = pool.get('product.product')
 
-                values = Line.create_values4complete(inventory, 0.)
-                for i, fname in enumerate(grouping, 1):
-                    values[fname] = key[i]
-                values['second_expected_quantity'] = second_qty
+        # Compute the second quantities of the location in one query
+        with Transaction().set_context(stock_date_end=inventory.date):
+            pbl = Product.products_by_location_compact(
+                [inventory.location.id], grouping=grouping)
+        product_index = grouping.index('product') + 1
+        second_uom_values = Product.get_second_uom_values(
+            set(pbl.columns[product_index]))
+        product_ids = [i for i, v in second_uom_values.iteritems() if v[0]]
+
+        # Update existing lines
+        to_write = []
+        lines = Line.search([
+                ('inventory', '=', inventory.id),
+                ('product.use_second_uom', '=', True),
+                ])
+        updated = set()
+        for line in lines:
+            key = (inventory.location.id,) + tuple(getattr(r, 'id', r)
+                for r in line.unique_key)
+            updated.add(key)
+            second_qty = pbl.get(key, 0.0)
+            if (line.second_quantity == line.second_expected_quantity
+                        == second_qty):
+                continue
+            values = {
+                'second_expected_quantity': second_qty,
+                }
+            if line.second_quantity == line.second_expected_quantity:
                 values['second_quantity'] = max(second_qty, 0.0)
-                to_create.append(values)
+            to_write.extend(([line], values))
+        if to_write:
+            Line.write(*to_write)
+
+        # Create lines if needed
+        products = dict((p.id, p) for p in Product.browse(product_ids))
+        to_create = []
+        for key, second_qty in pbl.iteritems():
+            if not second_qty or key in updated:
+                continue
+            product = products.get(key[product_index])
+            if (not product
+                    or product.type != 'goods' or product.consumable):
+                continue
+
+            values = Line.create_values4complete(inventory, 0.)
+            for i, fname in enumerate(grouping, 1):
+                values[fname] = key[i]
+            values['second_expected_quantity'] = second_qty
+            values['second_quantity'] = max(second_qty, 0.0)
+            to_create.append(values)
         if to_create:
             Line.create(to_create)
 
@@ -474,14 +2029,14 @@ class Inventory:
 class InventoryLine:
     __name__ = 'stock.inventory.line'
     use_second_uom = fields.Function(fields.Boolean('Use Second UoM'),
-        'on_change_with_use_second_uom')
+        'get_second_uom_fields')
     second_uom = fields.Function(fields.Many2One('product.uom', 'Second UoM',
             states={
                 'invisible': ~Eval('use_second_uom', False),
                 }, depends=['use_second_uom']),
-        'get_second_uom')
+        'get_second_uom_fields')
     second_unit_digits = fields.Function(fields.Integer('Second Unit Digits'),
-        'get_second_unit_digits')
+        'get_second_uom_fields')
     second_expected_quantity = fields.Float('Second UoM Expected Quantity',
         digits=(16, Eval('unit_digits', 2)), readonly=True, states={
             'required': Eval('use_second_uom', False),
@@ -511,65 +2066,111 @@ class InventoryLine:
             return True
         return False
 
-    def get_second_uom(self, name):
-        if self.use_second_uom:
-            return self.product.second_uom.id
-
     @staticmethod
     def default_unit_digits():
         return 2
 
-    def get_second_unit_digits(self, name):
-        if self.product.second_uom:
-            return self.product.second_uom.digits
-        return self.default_unit_digits()
+    @classmethod
+    def get_second_uom_fields(cls, lines, names):
+        Product = Pool().get('product.product')
+        values = Product.get_second_uom_values([l.product.id for l in lines])
+        result = {}
+        for name in names:
+            result[name] = {}
+            for line in lines:
+                use_second_uom, uom_id, _, digits = values[line.product.id]
+                if name == 'use_second_uom':
+                    result[name][line.id] = use_second_uom
+                elif name == 'second_uom':
+                    result[name][line.id] = (uom_id if use_second_uom
+                        else None)
+                elif name == 'second_unit_digits':
+                    result[name][line.id] = (digits if uom_id
+                        else cls.default_unit_digits())
+        return result
 
     @staticmethod
     def default_second_expected_quantity():
         return 0.
 
-    def get_move(self):
+    @classmethod
+    def get_second_quantity_deltas(cls, lines):
+        """
+        Return a dictionary with the id of the lines using the second UoM as
+        key and the second quantity delta rounded by the second UoM as value
+        """
+        Uom = Pool().get('product.uom')
+        lines = [l for l in lines if l.use_second_uom]
+        # Converting from the second UoM to itself only rounds
+        deltas = map(operator.sub,
+            [l.second_expected_quantity for l in lines],
+            [l.second_quantity for l in lines])
+        roundings = [l.second_uom.rounding for l in lines]
+        return dict(zip([l.id for l in lines],
+                map(Uom.round, deltas, roundings)))
+
+    @classmethod
+    def get_moves_values(cls, lines):
+        """
+        Return a dictionary with the id of the lines as key and the values to
+        create their move, or None if there is no delta, as value
+        """
         pool = Pool()
-        Move = pool.get('stock.move')
+        Inventory = pool.get('stock.inventory')
         Uom = pool.get('product.uom')
 
-        move = super(InventoryLine, self).get_move()
-        if not self.use_second_uom:
-            return move
-
-        delta_second_qty = Uom.compute_qty(self.second_uom,
-            self.second_expected_quantity - self.second_quantity,
-            self.second_uom)
-        if delta_second_qty == 0.0:
-            if move:
-                move.second_quantity = 0.
-                move.second_uom = self.second_uom
-            return move
-
-        from_location = self.inventory.location
-        to_location = self.inventory.lost_found
-        if move:
-            if move.from_location == to_location:  # inverse move
-                delta_second_qty = -delta_second_qty
-            move.second_quantity = delta_second_qty
-            move.second_uom = self.second_uom
-            return move
-
-        if delta_second_qty < 0:
-            (from_location, to_location, delta_second_qty) = \
-                (to_location, from_location, -delta_second_qty)
-        return Move(
-            from_location=from_location,
-            to_location=to_location,
-            product=self.product,
-            quantity=0.,
-            uom=self.uom,
-            second_quantity=delta_second_qty,
-            second_uom=self.second_uom,
-            company=self.inventory.company,
-            effective_date=self.inventory.date,
-            origin=self,
-            )
+        # Converting from the UoM of the line to itself only rounds
+        deltas = map(Uom.round,
+            map(operator.sub,
+                [l.expected_quantity for l in lines],
+                [l.quantity for l in lines]),
+            [l.uom.rounding for l in lines])
+        second_deltas = cls.get_second_quantity_deltas(lines)
+        grouping = Inventory.grouping()
+        values = {}
+        for line, delta in zip(lines, deltas):
+            second_delta = second_deltas.get(line.id, 0.)
+            if delta == 0.0 and second_delta == 0.0:
+                values[line.id] = None
+                continue
+            from_location = line.inventory.location
+            to_location = line.inventory.lost_found
+            if delta < 0 or (delta == 0.0 and second_delta < 0):
+                (from_location, to_location, delta, second_delta) = \
+                    (to_location, from_location, -delta, -second_delta)
+            move_values = {
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'quantity': delta,
+                'uom': line.uom.id,
+                'company': line.inventory.company.id,
+                'effective_date': line.inventory.date,
+                'origin': str(line),
+                }
+            for fname in grouping:
+                move_values[fname] = getattr(getattr(line, fname), 'id', None)
+            if line.use_second_uom:
+                move_values['second_quantity'] = second_delta
+                move_values['second_uom'] = line.second_uom.id
+            values[line.id] = move_values
+        return values
+
+    @classmethod
+    def prepare_moves_values(cls, lines):
+        "Compute at once the values of the moves returned by get_move"
+        return prepared_values('inventory_moves_values',
+            cls.get_moves_values(lines))
+
+    def get_move(self):
+        Move = Pool().get('stock.move')
+
+        moves_values = get_prepared_values('inventory_moves_values')
+        if self.id not in moves_values:
+            moves_values = self.get_moves_values([self])
+        values = moves_values[self.id]
+        if values is None:
+            return
+        return Move(**values)
 
     @classmethod
     def create_values4complete(cls, inventory, quantity):
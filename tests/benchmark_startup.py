@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the pool initialization with and without stock_second_uom.
+
+Each set of modules is installed in a new process on the test database
+(TRYTOND_DATABASE_URI and DB_NAME) where the registration of the classes and
+the initialization of the pool are timed, for example:
+
+    DB_NAME=:memory: python tests/benchmark_startup.py \\
+        --modules stock stock_second_uom stock_second_uom,sale,purchase
+
+The timings are written as JSON to compare them between releases.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pool initialization')
+    parser.add_argument('--modules', nargs='+',
+        default=['stock', 'stock_second_uom'],
+        help='comma separated modules to install for each run')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of initializations of the pool by run')
+    parser.add_argument('--output', default=None,
+        help='file to write the results (default: standard output)')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def durations_results(durations):
+    return OrderedDict([
+            ('runs', len(durations)),
+            ('min', min(durations)),
+            ('mean', sum(durations) / len(durations)),
+            ('max', max(durations)),
+            ])
+
+
+def child(modules, repeat):
+    "Time the pool of the modules in the current process"
+    from trytond.pool import Pool
+
+    start = time.time()
+    Pool.start()
+    pool_start = time.time() - start
+
+    # The test module reads DB_NAME when imported
+    from trytond.tests.test_tryton import DB_NAME, install_module
+    for module in modules:
+        install_module(module)
+
+    durations = []
+    for i in xrange(repeat):
+        Pool.stop(DB_NAME)
+        start = time.time()
+        Pool(DB_NAME).init()
+        durations.append(time.time() - start)
+
+    return OrderedDict([
+            ('pool_start', pool_start),
+            ('pool_init', durations_results(durations)),
+            ])
+
+
+def main():
+    args = parse_arguments()
+    os.environ.setdefault('DB_NAME', ':memory:')
+
+    if args.child:
+        json.dump(child(args.child.split(','), args.repeat), sys.stdout)
+        return
+
+    results = OrderedDict()
+    for modules in args.modules:
+        output = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--child', modules,
+                '--repeat', str(args.repeat)])
+        results[modules] = json.loads(output, object_pairs_hook=OrderedDict)
+
+    report = OrderedDict([
+            ('module', 'stock_second_uom'),
+            ('date', datetime.datetime.now().isoformat()),
+            ('parameters', vars(args)),
+            ('results', results),
+            ])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+
+if __name__ == '__main__':
+    main()
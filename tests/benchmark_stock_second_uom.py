@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark of the second UoM stock operations on synthetic data.
+
+It uses the same database setup as the tests, so the backend is selected
+with TRYTOND_DATABASE_URI and the database with DB_NAME, for example:
+
+    DB_NAME=:memory: python tests/benchmark_stock_second_uom.py \\
+        --products 500 --moves 20 --output benchmark.json
+
+The timings are written as JSON to compare them between releases.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond import backend
+from trytond.transaction import Transaction
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the second UoM stock operations')
+    parser.add_argument('--products', type=int, default=100,
+        help='number of products using the second UoM')
+    parser.add_argument('--lots', type=int, default=0,
+        help='number of lots by product (installs stock_lot)')
+    parser.add_argument('--moves', type=int, default=10,
+        help='number of done moves by product')
+    parser.add_argument('--periods', type=int, default=2,
+        help='number of periods to close')
+    parser.add_argument('--days', type=int, default=90,
+        help='number of days on which the moves are spread')
+    parser.add_argument('--batch', type=int, default=1000,
+        help='number of moves created and written at once')
+    parser.add_argument('--shipment-lines', type=int, default=100,
+        help='number of outgoing moves of the customer shipment')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of runs of the repeatable operations')
+    parser.add_argument('--output', default=None,
+        help='file to write the results (default: standard output)')
+    return parser.parse_args()
+
+
+class Timer(object):
+    'Collect the durations of named operations'
+
+    def __init__(self):
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.time()
+        yield
+        self.durations.setdefault(name, []).append(time.time() - start)
+
+    def results(self):
+        results = OrderedDict()
+        for name, durations in self.durations.iteritems():
+            results[name] = OrderedDict([
+                    ('runs', len(durations)),
+                    ('min', min(durations)),
+                    ('mean', sum(durations) / len(durations)),
+                    ('max', max(durations)),
+                    ])
+        return results
+
+
+class Benchmark(object):
+    'Generate the synthetic data and time the operations'
+
+    def __init__(self, pool, args):
+        self.pool = pool
+        self.args = args
+        self.timer = Timer()
+        self.today = pool.get('ir.date').today()
+
+    def setup(self):
+        pool = self.pool
+        Location = pool.get('stock.location')
+        Uom = pool.get('product.uom')
+
+        self.supplier, = Location.search([('code', '=', 'SUP')])
+        self.customer, = Location.search([('code', '=', 'CUS')])
+        self.storage, = Location.search([('code', '=', 'STO')])
+        self.output, = Location.search([('code', '=', 'OUT')])
+        self.lost_found, = Location.search([('type', '=', 'lost_found')])
+        self.kg, = Uom.search([('name', '=', 'Kilogram')])
+        self.unit, = Uom.search([('name', '=', 'Unit')])
+
+        self.create_company()
+        self.create_products()
+        self.create_moves()
+
+    def create_company(self):
+        pool = self.pool
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        Party = pool.get('party.party')
+        User = pool.get('res.user')
+
+        self.currency, = Currency.create([{
+                    'name': 'Benchmark Currency',
+                    'symbol': 'B',
+                    'code': 'BCH',
+                    }])
+        party, self.party = Party.create([{
+                    'name': 'Benchmark Company',
+                    }, {
+                    'name': 'Benchmark Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        self.company, = Company.create([{
+                    'party': party.id,
+                    'currency': self.currency.id,
+                    }])
+        User.write([User(Transaction().user)], {
+                'main_company': self.company.id,
+                'company': self.company.id,
+                })
+
+    def create_products(self):
+        pool = self.pool
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        templates = Template.create([{
+                    'name': 'Benchmark %s' % i,
+                    'type': 'goods',
+                    'list_price': Decimal(10),
+                    'cost_price': Decimal(5),
+                    'cost_price_method': 'fixed',
+                    'default_uom': self.kg.id,
+                    'second_uom': self.unit.id,
+                    } for i in xrange(self.args.products)])
+        self.products = Product.create([{
+                    'template': t.id,
+                    'use_second_uom': True,
+                    } for t in templates])
+
+        self.lots = {}
+        if self.args.lots:
+            Lot = pool.get('stock.lot')
+            lots = Lot.create([{
+                        'number': '%s-%s' % (p.id, i),
+                        'product': p.id,
+                        } for p in self.products
+                    for i in xrange(self.args.lots)])
+            for lot in lots:
+                self.lots.setdefault(lot.product.id, []).append(lot)
+
+    def move_values(self, product, index, from_location, to_location,
+            quantity, effective_date=None):
+        values = {
+            'product': product.id,
+            'uom': self.kg.id,
+            'quantity': quantity,
+            'second_uom': self.unit.id,
+            'second_quantity': quantity / 10.,
+            'from_location': from_location.id,
+            'to_location': to_location.id,
+            'effective_date': effective_date,
+            'company': self.company.id,
+            'unit_price': Decimal(5),
+            'currency': self.currency.id,
+            }
+        lots = self.lots.get(product.id)
+        if lots:
+            values['lot'] = lots[index % len(lots)].id
+        return values
+
+    def create_moves(self):
+        Move = self.pool.get('stock.move')
+
+        days, moves = self.args.days, self.args.moves
+        vlist = []
+        for product in self.products:
+            for i in xrange(moves):
+                date = self.today - datetime.timedelta(
+                    days=days - i * days // moves)
+                # One outgoing move for three incoming ones
+                if i % 4 == 3:
+                    vlist.append(self.move_values(product, i, self.storage,
+                            self.customer, 10., date))
+                else:
+                    vlist.append(self.move_values(product, i, self.supplier,
+                            self.storage, 20., date))
+        for i in xrange(0, len(vlist), self.args.batch):
+            moves = Move.create(vlist[i:i + self.args.batch])
+            Move.do(moves)
+
+    def run(self):
+        self.bench_products_by_location('before_periods')
+        self.bench_move_create_write()
+        self.bench_period_close()
+        self.bench_products_by_location('after_periods')
+        self.bench_inventory()
+        self.bench_shipment_out_sync()
+        return self.timer.results()
+
+    def bench_products_by_location(self, suffix):
+        from trytond.modules.stock_second_uom.stock import (
+            products_by_location_cache)
+        Product = self.pool.get('product.product')
+        groupings = [('product',)]
+        if self.lots:
+            groupings.append(('product', 'lot'))
+        for grouping in groupings:
+            name = 'products_by_location_%s_%s' % (
+                '_'.join(grouping), suffix)
+            for i in xrange(self.args.repeat):
+                # Time the queries instead of the cache of the transaction
+                products_by_location_cache().clear()
+                with Transaction().set_context(stock_date_end=self.today,
+                        second_uom=True), self.timer(name):
+                    Product.products_by_location([self.storage.id],
+                        grouping=grouping)
+            for i in xrange(self.args.repeat):
+                products_by_location_cache().clear()
+                with Transaction().set_context(stock_date_end=self.today), \
+                        self.timer(name + '_compact'):
+                    Product.products_by_location_compact([self.storage.id],
+                        grouping=grouping)
+
+    def bench_move_create_write(self):
+        Move = self.pool.get('stock.move')
+        vlist = [self.move_values(self.products[i % len(self.products)], i,
+                self.supplier, self.storage, 5.)
+            for i in xrange(self.args.batch)]
+        for i in xrange(self.args.repeat):
+            with self.timer('move_create'):
+                moves = Move.create(vlist)
+            with self.timer('move_write'):
+                Move.write(moves, {
+                        'second_quantity': 2.,
+                        })
+            Move.delete(moves)
+
+    def bench_period_close(self):
+        Period = self.pool.get('stock.period')
+        days, periods = self.args.days, self.args.periods
+        for i in xrange(periods, 0, -1):
+            period, = Period.create([{
+                        'date': self.today - datetime.timedelta(
+                            days=i * days // (periods + 1)),
+                        'company': self.company.id,
+                        }])
+            with self.timer('period_close'):
+                Period.close([period])
+
+    def bench_inventory(self):
+        Inventory = self.pool.get('stock.inventory')
+        inventory, = Inventory.create([{
+                    'location': self.storage.id,
+                    'lost_found': self.lost_found.id,
+                    'company': self.company.id,
+                    'date': self.today,
+                    }])
+        with self.timer('inventory_complete_lines'):
+            Inventory.complete_lines([inventory])
+        with self.timer('inventory_complete_lines_update'):
+            Inventory.complete_lines([inventory])
+        with self.timer('inventory_confirm'):
+            Inventory.confirm([inventory])
+
+    def bench_shipment_out_sync(self):
+        ShipmentOut = self.pool.get('stock.shipment.out')
+        products = self.products
+        shipment, = ShipmentOut.create([{
+                    'customer': self.party.id,
+                    'delivery_address': self.party.addresses[0].id,
+                    'company': self.company.id,
+                    'planned_date': self.today,
+                    'moves': [('create', [
+                                self.move_values(products[i % len(products)],
+                                    i, self.output, self.customer, 1.)
+                                for i in xrange(self.args.shipment_lines)])],
+                    }])
+        ShipmentOut.wait([shipment])
+        for i in xrange(self.args.repeat):
+            with self.timer('shipment_out_sync_inventory_to_outgoing'):
+                ShipmentOut._sync_inventory_to_outgoing([shipment])
+
+
+def main():
+    args = parse_arguments()
+    os.environ.setdefault('DB_NAME', ':memory:')
+
+    # The test module reads DB_NAME when imported
+    from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, \
+        install_module
+
+    install_module('stock_second_uom')
+    if args.lots:
+        install_module('stock_lot')
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        benchmark = Benchmark(POOL, args)
+        benchmark.setup()
+        results = benchmark.run()
+        transaction.cursor.rollback()
+
+    report = OrderedDict([
+            ('module', 'stock_second_uom'),
+            ('date', datetime.datetime.now().isoformat()),
+            ('backend', backend.name()),
+            ('parameters', vars(args)),
+            ('results', results),
+            ])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+
+if __name__ == '__main__':
+    main()
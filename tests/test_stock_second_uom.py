@@ -1,17 +1,173 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
 import doctest
 import unittest
+from collections import OrderedDict
+from decimal import Decimal
+from sql import Join, Literal, Select, Table, Union
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from sql.operators import Neg
+
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import test_view, test_depends
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, test_view,\
+    test_depends
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.modules.stock_second_uom.stock import _query_counter
 
 
-class TestCase(unittest.TestCase):
-    'Test module'
+def rewrite_quantity_columns(query, move_table, tables):
+    "Second UoM rewriting of compute_quantities_query done by walking it"
+    def second_qty_column(table):
+        if table._name != move_table:
+            return Coalesce(table.second_internal_quantity, Literal(0))
+        return Sum(Coalesce(table.second_internal_quantity, Literal(0)))
+
+    def find_table(join):
+        if not isinstance(join, Join):
+            return
+        for pos in ['left', 'right']:
+            item = getattr(join, pos)
+            if isinstance(item, Table):
+                if item._name in tables:
+                    return item
+            else:
+                return find_table(item)
+
+    def find_queries(query):
+        if isinstance(query, Union):
+            for sub_query in query.queries:
+                for q in find_queries(sub_query):
+                    yield q
+        elif isinstance(query, Select):
+            yield query
+
+    union, = query.from_
+    for sub_query in find_queries(union):
+        for table in sub_query.from_:
+            if isinstance(table, Table) and table._name in tables:
+                second_qty_col = second_qty_column(table)
+                break
+            found = find_table(table)
+            if found:
+                second_qty_col = second_qty_column(found)
+                break
+        else:
+            continue
+        columns = []
+        for col in sub_query.columns:
+            if col.output_name == 'quantity':
+                if isinstance(col.expression, Neg):
+                    columns.append((-second_qty_col).as_('quantity'))
+                else:
+                    columns.append(second_qty_col.as_('quantity'))
+            else:
+                columns.append(col)
+        sub_query.columns = tuple(columns)
+    return query
+
+
+class TestMixin(object):
+    'Installation of the modules and creation of the test records'
+    modules = ['stock_second_uom']
 
     def setUp(self):
-        trytond.tests.test_tryton.install_module('stock_second_uom')
+        for module in self.modules:
+            trytond.tests.test_tryton.install_module(module)
+        self.uom = POOL.get('product.uom')
+        self.location = POOL.get('stock.location')
+        self.move = POOL.get('stock.move')
+        self.date = POOL.get('ir.date')
+        self.template = POOL.get('product.template')
+        self.product = POOL.get('product.product')
+        self.company = POOL.get('company.company')
+        self.currency = POOL.get('currency.currency')
+        self.party = POOL.get('party.party')
+        self.user = POOL.get('res.user')
+        self.period = POOL.get('stock.period')
+
+    def create_company(self):
+        currency, = self.currency.create([{
+                    'name': 'Second UoM',
+                    'symbol': 'S',
+                    'code': 'SUM',
+                    }])
+        party, = self.party.create([{
+                    'name': 'Second UoM',
+                    }])
+        company, = self.company.create([{
+                    'party': party.id,
+                    'currency': currency.id,
+                    }])
+        self.user.write([self.user(USER)], {
+                'main_company': company.id,
+                'company': company.id,
+                })
+        return company
+
+    def create_product(self, name, default_uom, second_uom,
+            use_second_uom=True):
+        "Create a goods product of a new template with second_uom"
+        template, = self.template.create([{
+                    'name': name,
+                    'type': 'goods',
+                    'list_price': Decimal(1),
+                    'cost_price': Decimal(1),
+                    'cost_price_method': 'fixed',
+                    'default_uom': default_uom.id,
+                    'second_uom': second_uom.id,
+                    }])
+        product, = self.product.create([{
+                    'template': template.id,
+                    'use_second_uom': use_second_uom,
+                    }])
+        return product
+
+    def create_moves(self, company, vlist):
+        '''
+        Create the moves of company for vlist completed with the product UoMs
+        and a unit price. The records of the values are replaced by their id.
+        '''
+        to_create = []
+        for values in vlist:
+            product = values['product']
+            move_values = {
+                'uom': product.default_uom,
+                'company': company,
+                'unit_price': Decimal(1),
+                'currency': company.currency,
+                }
+            if product.use_second_uom:
+                move_values['second_uom'] = product.template.second_uom
+            move_values.update(values)
+            to_create.append(dict((k, getattr(v, 'id', v))
+                    for k, v in move_values.iteritems()))
+        return self.move.create(to_create)
+
+    def get_uoms(self, *names):
+        "Return the UoMs of names in the same order"
+        uoms = dict((u.name, u)
+            for u in self.uom.search([('name', 'in', names)]))
+        return [uoms[n] for n in names]
+
+    def get_locations(self, *codes):
+        "Return the locations of codes in the same order"
+        locations = dict((l.code, l)
+            for l in self.location.search([('code', 'in', codes)]))
+        return [locations[c] for c in codes]
+
+    def count_queries(self, func, *args):
+        "Return the number of queries executed by func"
+        with _query_counter() as queries:
+            func(*args)
+        return queries[0]
+
+
+class TestCase(TestMixin, unittest.TestCase):
+    'Test module'
 
     def test0005views(self):
         'Test views'
@@ -21,10 +177,1110 @@ class TestCase(unittest.TestCase):
         'Test depends'
         test_depends()
 
+    def test0010uom_conversion_cache(self):
+        'Test Uom.compute_qty_cached'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            uoms = self.uom.search([])
+            self.uom.conversion_cache_stats(reset=True)
+            for from_uom in uoms:
+                for to_uom in uoms:
+                    for quantity in (0, 1, 3.7, -12.5):
+                        self.assertEqual(
+                            self.uom.compute_qty_cached(from_uom, quantity,
+                                to_uom),
+                            self.uom.compute_qty(from_uom, quantity, to_uom))
+                        self.assertEqual(
+                            self.uom.compute_qty_cached(from_uom.id, quantity,
+                                to_uom.id, round=False),
+                            self.uom.compute_qty(from_uom, quantity, to_uom,
+                                round=False))
+            stats = self.uom.conversion_cache_stats()
+            self.assertLessEqual(stats['misses'], len(uoms) ** 2)
+            self.assertGreaterEqual(stats['hits'], 5 * len(uoms) ** 2)
+
+            kg, = self.uom.search([('symbol', '=', 'kg')])
+            self.uom.conversion_cache_stats(reset=True)
+            self.uom.compute_qty_cached(kg, 1, kg)
+            self.uom.write([kg], {'digits': kg.digits})
+            self.uom.compute_qty_cached(kg, 1, kg)
+            self.assertEqual(self.uom.conversion_cache_stats()['misses'], 1)
+
+    def test0020compute_quantities_query(self):
+        'Test second UoM Move.compute_quantities_query'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            today = self.date.today()
+            storage, warehouse = self.get_locations('STO', 'WH')
+            tables = self.move._second_quantity_tables()
+            groupings = [('product',)]
+            if 'lot' in self.move._fields:
+                groupings.append(('product', 'lot'))
+            contexts = [
+                {},
+                {'stock_date_end': today},
+                {'stock_date_end': today - datetime.timedelta(days=10)},
+                {'stock_date_end': today + datetime.timedelta(days=10),
+                    'forecast': True},
+                {'stock_date_start': today - datetime.timedelta(days=10),
+                    'stock_date_end': today},
+                {'stock_date_start': today + datetime.timedelta(days=5),
+                    'stock_date_end': today + datetime.timedelta(days=10)},
+                {'stock_date_end': today, 'stock_assign': True},
+                {'stock_destinations': [storage.id]},
+                ]
+            for grouping in groupings:
+                filters = [None, ([1, 2],) + (None,) * (len(grouping) - 1)]
+                for context in contexts:
+                    for with_childs in (False, True):
+                        for grouping_filter in filters:
+                            args = ([storage.id, warehouse.id], with_childs,
+                                grouping, grouping_filter)
+                            with Transaction().set_context(context,
+                                    second_uom=False):
+                                expected = rewrite_quantity_columns(
+                                    self.move.compute_quantities_query(*args),
+                                    self.move._table, tables)
+                            with Transaction().set_context(context,
+                                    second_uom=True):
+                                # Twice to use the stored plan
+                                for i in range(2):
+                                    query = (
+                                        self.move.compute_quantities_query(
+                                            *args))
+                                    self.assertEqual(tuple(query),
+                                        tuple(expected))
+
+    def test0025quantity_plan(self):
+        'Test the plan of the second quantity columns'
+        from trytond.modules.stock_second_uom.stock import (_quantity_plan,
+            _resolve_quantity_plan)
+        move = Table('stock_move')
+        other = Table('other')
+        tables = set(['stock_move'])
+
+        def select(table):
+            return table.select(table.location,
+                Sum(table.quantity).as_('quantity'))
+        union = Union(select(move), select(other))
+        plan = _quantity_plan(union, tables)
+        (query, table, _, _), = _resolve_quantity_plan(union, plan, tables)
+        self.assertIs(query, union.queries[0])
+        self.assertEqual(table._name, 'stock_move')
+        # A union with other selects does not match the plan
+        for other_union in [
+                Union(select(move), select(other), select(move)),
+                Union(select(other), select(move)),
+                Union(select(move), Union(select(other), select(other))),
+                ]:
+            self.assertIsNone(_resolve_quantity_plan(other_union, plan,
+                    tables))
+
+    def test0030second_uom_fields_queries(self):
+        'Test second UoM function fields read in constant queries'
+        Inventory = POOL.get('stock.inventory')
+        InventoryLine = POOL.get('stock.inventory.line')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            products = [self.create_product('Second UoM %s' % i, kg, unit,
+                    use_second_uom=bool(i % 2)) for i in range(40)]
+            moves = self.create_moves(company, [{
+                        'product': p,
+                        'quantity': 1,
+                        'second_quantity': 1 if p.use_second_uom else None,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        } for p in products])
+            lost_found, = self.location.search([('type', '=', 'lost_found')])
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'lost_found': lost_found.id,
+                        'company': company.id,
+                        'date': self.date.today(),
+                        }])
+            lines = InventoryLine.create([{
+                        'inventory': inventory.id,
+                        'product': p.id,
+                        'expected_quantity': 0,
+                        'quantity': 1,
+                        'second_quantity': 1 if p.use_second_uom else None,
+                        } for p in products])
+
+            for Model, records, fields in [
+                    (self.product, products, ['second_uom']),
+                    (self.move, moves,
+                        ['use_second_uom', 'product_second_uom_category']),
+                    (InventoryLine, lines,
+                        ['use_second_uom', 'second_uom',
+                            'second_unit_digits']),
+                    ]:
+                ids = [r.id for r in records]
+                counts = [self.count_queries(Model.read, ids[:n], fields)
+                    for n in (2, 10, 40)]
+                self.assertEqual(len(set(counts)), 1, (Model.__name__,
+                        counts))
+
+            values = self.move.read([m.id for m in moves],
+                ['product', 'use_second_uom', 'product_second_uom_category'])
+            for value in values:
+                product = self.product(value['product'])
+                self.assertEqual(value['use_second_uom'],
+                    product.use_second_uom)
+                self.assertEqual(value['product_second_uom_category'],
+                    unit.category.id if product.use_second_uom else None)
+
+            values = InventoryLine.read([l.id for l in lines],
+                ['product', 'use_second_uom', 'second_uom',
+                    'second_unit_digits'])
+            for value in values:
+                product = self.product(value['product'])
+                self.assertEqual(value['use_second_uom'],
+                    product.use_second_uom)
+                self.assertEqual(value['second_uom'],
+                    unit.id if product.use_second_uom else None)
+                self.assertEqual(value['second_unit_digits'], unit.digits)
+
+    def test0040second_uom_stored_values(self):
+        'Test use second UoM flag and category stored on moves'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            product = self.create_product('Stored Second UoM', kg, unit)
+            move, = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 1,
+                        'second_uom': None,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        }])
+
+            def stored_values():
+                value, = self.move.read([move.id],
+                    ['use_second_uom', 'product_second_uom_category'])
+                return (value['use_second_uom'],
+                    value['product_second_uom_category'])
+            self.assertEqual(stored_values(), (True, unit.category.id))
+            self.assertIn(move, self.move.search([
+                        ('use_second_uom', '=', True),
+                        ]))
+
+            self.product.write([product], {'use_second_uom': False})
+            self.assertEqual(stored_values(), (False, None))
+            self.assertNotIn(move, self.move.search([
+                        ('use_second_uom', '=', True),
+                        ]))
+
+            self.product.write([product], {'use_second_uom': True})
+            self.assertEqual(stored_values(), (True, unit.category.id))
+
+    def test0050move_validate(self):
+        'Test second UoM Move.validate'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            product = self.create_product('Validate Second UoM', kg, unit)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': i + 1,
+                        'second_quantity': 1,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        } for i in range(5)])
+            with self.assertRaises(UserError) as cm:
+                self.move.write(moves[2:], {
+                        'second_quantity': -1,
+                        })
+            # All the invalid moves are reported in one error
+            for move in moves:
+                if move in moves[2:]:
+                    self.assertIn(move.rec_name, cm.exception.message)
+                else:
+                    self.assertNotIn(move.rec_name, cm.exception.message)
+            self.move.write(moves[2:], {
+                    'second_quantity': None,
+                    })
+            self.assertRaises(UserError, self.move.do, moves)
+            self.move.do(moves[:2])
+
+            moves[0].check_second_uom_required()
+            moves[0].check_second_quantity_positive()
+
+    def test0060period_backward_quantities(self):
+        'Test second quantities computed backward from a closed period'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage, customer = self.get_locations(
+                'SUP', 'STO', 'CUS')
+            today = self.date.today()
+            product = self.create_product('Period Second UoM', kg, unit)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': quantity,
+                        'second_quantity': second_quantity,
+                        'from_location': from_location,
+                        'to_location': to_location,
+                        'effective_date': today - datetime.timedelta(
+                            days=days),
+                        } for quantity, second_quantity, from_location,
+                    to_location, days in [
+                        (100, 10, supplier, storage, 20),
+                        (30, 3, storage, customer, 5),
+                        (10, 1, storage, customer, 1),
+                        ]])
+            self.move.do(moves)
+            period, = self.period.create([{
+                        'date': today - datetime.timedelta(days=2),
+                        'company': company.id,
+                        }])
+            self.period.close([period])
+            # The company rule on moves applies to the user
+            self.assertTrue(POOL.get('ir.rule').domain_get('stock.move'))
+
+            for days, expected in [(21, 0), (10, 10), (4, 7), (2, 7)]:
+                context = {
+                    'stock_date_end': today - datetime.timedelta(days=days),
+                    'second_uom': True,
+                    }
+                with Transaction().set_context(context):
+                    self.assertIsNotNone(
+                        self.period.compute_second_quantities_query(
+                            [storage.id]))
+                    quantities = self.product.products_by_location(
+                        [storage.id], [product.id])
+                self.assertEqual(
+                    quantities.get((storage.id, product.id), 0), expected)
+
+                # The assigned moves are not supported backward
+                with Transaction().set_context(context, stock_assign=True):
+                    self.assertIsNone(
+                        self.period.compute_second_quantities_query(
+                            [storage.id]))
+                    quantities = self.product.products_by_location(
+                        [storage.id], [product.id])
+                self.assertEqual(
+                    quantities.get((storage.id, product.id), 0), expected)
+
+    def test0070products_by_location_cache(self):
+        'Test products_by_location cache of second quantities'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            product = self.create_product('Cache Second UoM', kg, unit)
+            values = {
+                'product': product,
+                'quantity': 10,
+                'second_quantity': 1,
+                'from_location': supplier,
+                'to_location': storage,
+                }
+            self.move.do(self.create_moves(company, [values]))
+
+            def second_quantity():
+                with Transaction().set_context(second_uom=True,
+                        stock_date_end=self.date.today()):
+                    quantities = self.product.products_by_location(
+                        [storage.id], [product.id])
+                    # The result must not be shared with the cache
+                    quantities.clear()
+                    return self.product.products_by_location(
+                        [storage.id], [product.id])[(storage.id, product.id)]
+
+            self.product.products_by_location_cache_stats(reset=True)
+            self.assertEqual(second_quantity(), 1)
+            self.assertEqual(self.product.products_by_location_cache_stats(),
+                {'hits': 1, 'misses': 1})
+
+            self.move.do(self.create_moves(company, [values]))
+            self.assertEqual(second_quantity(), 2)
+            self.assertEqual(self.product.products_by_location_cache_stats(),
+                {'hits': 2, 'misses': 2})
+
+            # Changing the second UoM clears the cache
+            self.template.write([product.template], {
+                    'second_uom': unit.id,
+                    })
+            self.assertEqual(second_quantity(), 2)
+            self.assertEqual(self.product.products_by_location_cache_stats(),
+                {'hits': 3, 'misses': 3})
+
+            # Changing the tree of the locations or deactivating a product
+            # clears the cache
+            warehouse, = self.get_locations('WH')
+            child, = self.location.create([{
+                        'name': 'Child',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            self.location.write([child], {
+                    'parent': warehouse.id,
+                    })
+            self.assertEqual(second_quantity(), 2)
+            self.assertEqual(self.product.products_by_location_cache_stats(),
+                {'hits': 4, 'misses': 4})
+            self.product.write([product], {
+                    'active': False,
+                    })
+            self.assertEqual(second_quantity(), 2)
+            self.assertEqual(self.product.products_by_location_cache_stats(),
+                {'hits': 5, 'misses': 5})
+
+    def test0080instrumentation(self):
+        'Test instrumentation of the second UoM methods'
+        from trytond.modules.stock_second_uom.stock import (
+            instrumentation_stats)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            storage, = self.get_locations('STO')
+            with Transaction().set_context(second_uom=True):
+                self.move.compute_quantities_query([storage.id])
+            self.assertNotIn('Move.compute_quantities_query',
+                instrumentation_stats())
+
+            with Transaction().set_context(second_uom=True,
+                    second_uom_instrumentation=True):
+                for i in range(2):
+                    self.move.compute_quantities_query([storage.id])
+            stats = instrumentation_stats(reset=True)
+            self.assertEqual(stats['Move.compute_quantities_query']['calls'],
+                2)
+            # Each call searches the last closed period
+            self.assertEqual(
+                stats['Move.compute_quantities_query']['queries'], 2)
+            self.assertNotIn('rows', stats['Move.compute_quantities_query'])
+            self.assertEqual(instrumentation_stats(), {})
+
+    def test0090search_second_quantity(self):
+        'Test search on second quantity'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage, warehouse = self.get_locations(
+                'SUP', 'STO', 'WH')
+            product1, product2, product3 = products = [
+                self.create_product('Search Second UoM', kg, unit)
+                for _ in range(3)]
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': second_quantity * 10,
+                        'second_quantity': second_quantity,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': self.date.today(),
+                        } for product, second_quantity in [
+                        (product1, 5), (product2, 1)]])
+            self.move.do(moves)
+
+            for clause, expected in [
+                    (('second_quantity', '>', 0), [product1, product2]),
+                    (('second_quantity', '>=', 5), [product1]),
+                    (('second_quantity', '=', 0), [product3]),
+                    (('second_quantity', '<', 2), [product2, product3]),
+                    (('second_quantity', '!=', 1), [product1, product3]),
+                    (('second_quantity', 'in', [0, 1]),
+                        [product2, product3]),
+                    ]:
+                for location in (storage, warehouse):
+                    with Transaction().set_context(locations=[location.id],
+                            stock_date_end=self.date.today()):
+                        found = self.product.search([
+                                ('id', 'in', [p.id for p in products]),
+                                clause,
+                                ])
+                    self.assertEqual(set(found), set(expected),
+                        msg=(clause, location.code))
+
+            # Fractional second quantities that cancel out are zero
+            customer, = self.get_locations('CUS')
+            product4 = self.create_product('Search Second UoM', unit, kg)
+            moves = self.create_moves(company, [{
+                        'product': product4,
+                        'quantity': 1,
+                        'second_quantity': second_quantity,
+                        'from_location': from_location,
+                        'to_location': to_location,
+                        'effective_date': self.date.today(),
+                        } for second_quantity, from_location, to_location in [
+                        (0.1, supplier, storage), (0.2, supplier, storage),
+                        (0.3, storage, customer)]])
+            self.move.do(moves)
+            for clause, expected in [
+                    (('second_quantity', '=', 0), [product4]),
+                    (('second_quantity', '>', 0), []),
+                    (('second_quantity', '<', 0), []),
+                    (('second_quantity', 'in', [0]), [product4]),
+                    ]:
+                with Transaction().set_context(locations=[storage.id],
+                        stock_date_end=self.date.today()):
+                    found = self.product.search([
+                            ('id', '=', product4.id),
+                            clause,
+                            ])
+                self.assertEqual(found, expected, msg=clause)
+
+            # The search rounds like the second quantity of the product which
+            # is rounded by the default UoM
+            product5 = self.create_product('Search Second UoM', unit, kg)
+            moves = self.create_moves(company, [{
+                        'product': product5,
+                        'quantity': 1,
+                        'second_quantity': 0.3,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': self.date.today(),
+                        }])
+            self.move.do(moves)
+            with Transaction().set_context(locations=[storage.id],
+                    stock_date_end=self.date.today()):
+                self.assertEqual(self.product(product5.id).second_quantity, 0)
+                for clause, expected in [
+                        (('second_quantity', '=', 0), [product5]),
+                        (('second_quantity', '>', 0), []),
+                        ]:
+                    found = self.product.search([
+                            ('id', '=', product5.id),
+                            clause,
+                            ])
+                    self.assertEqual(found, expected, msg=clause)
+
+    def test0100compact_quantities(self):
+        'Test compact second quantities of products_by_location'
+        from trytond.modules.stock_second_uom.stock import CompactQuantities
+        quantities = CompactQuantities.from_dict(3, {
+                (1, 2, None): 1.5,
+                (1, 2, 3): 2.,
+                (4, 1, None): -1.,
+                })
+        self.assertEqual(len(quantities), 3)
+        self.assertEqual(quantities[(1, 2, None)], 1.5)
+        self.assertEqual(quantities.get((4, 1, None)), -1.)
+        self.assertIsNone(quantities.get((1, 3, None)))
+        self.assertNotIn((1, 2), quantities)
+        self.assertEqual(quantities.keys(),
+            [(1, 2, None), (1, 2, 3), (4, 1, None)])
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage, customer = self.get_locations(
+                'SUP', 'STO', 'CUS')
+            products = [self.create_product('Compact Second UoM', kg, unit)
+                for _ in range(3)]
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10 * (i + 1),
+                        'second_quantity': i + 1,
+                        'from_location': from_location,
+                        'to_location': to_location,
+                        'effective_date': self.date.today(),
+                        } for i, product in enumerate(products)
+                    for from_location, to_location in [
+                        (supplier, storage), (supplier, storage),
+                        (storage, customer)]])
+            self.move.do(moves)
+
+            location_ids = [storage.id, customer.id]
+            with Transaction().set_context(stock_date_end=self.date.today()):
+                compact = self.product.products_by_location_compact(
+                    location_ids)
+                with Transaction().set_context(second_uom=True):
+                    expected = self.product.products_by_location(
+                        location_ids)
+            self.assertIsInstance(compact, CompactQuantities)
+            self.assertEqual(dict(compact.iteritems()), expected)
+            self.assertEqual(compact[(storage.id, products[2].id)], 3)
+
+    def test0110recompute_second_quantities(self):
+        'Test recompute second quantities after changing the second UoM'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, gram, unit = self.get_uoms('Kilogram', 'Gram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            today = self.date.today()
+            product = self.create_product('Recompute Second UoM', unit, kg)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': 2,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': today - datetime.timedelta(days=2),
+                        }] * 3)
+            self.move.do(moves)
+            period, = self.period.create([{
+                        'date': today - datetime.timedelta(days=1),
+                        'company': company.id,
+                        }])
+            self.period.close([period])
+
+            self.template.write([product.template], {
+                    'second_uom': gram.id,
+                    })
+            self.assertEqual(
+                self.product.recompute_second_quantities([product.id]), 3)
+            self.assertEqual([m['second_internal_quantity']
+                    for m in self.move.read([m.id for m in moves],
+                        ['second_internal_quantity'])],
+                [2000, 2000, 2000])
+            cache, = POOL.get('stock.period.cache').search_read([
+                    ('period', '=', period.id),
+                    ('product', '=', product.id),
+                    ('location', '=', storage.id),
+                    ], fields_names=['second_internal_quantity'])
+            self.assertEqual(cache['second_internal_quantity'], 6000)
+
+            # Nothing to update when it is run again
+            self.assertEqual(
+                self.product.recompute_second_quantities([product.id]), 0)
+
+    def test0120check_second_internal_quantities(self):
+        'Test check and repair of second internal quantities'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            product = self.create_product('Check Second UoM', kg, unit)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': i + 1,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        } for i in range(3)])
+            table = self.move.__table__()
+            Transaction().cursor.execute(*table.update(
+                    [table.second_internal_quantity], [42],
+                    where=table.id == moves[1].id))
+
+            report = self.move.check_second_internal_quantities([product.id])
+            self.assertEqual(report['checked'], 3)
+            self.assertEqual(report['mismatches'], 1)
+            self.assertEqual(report['repaired'], 0)
+            self.assertEqual(report['last_id'], max(m.id for m in moves))
+
+            report = self.move.check_second_internal_quantities(
+                [product.id], repair=True)
+            self.assertEqual(report['repaired'], 1)
+            move, = self.move.read([moves[1].id],
+                ['second_internal_quantity'])
+            self.assertEqual(move['second_internal_quantity'], 2)
+            self.assertEqual(self.move.check_second_internal_quantities(
+                    [product.id])['mismatches'], 0)
+
+    def test0130second_quantity_snapshot(self):
+        'Test second quantities from the snapshot by company'
+        Snapshot = POOL.get('stock.second_quantity.snapshot')
+        Configuration = POOL.get('stock.configuration')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            today = self.date.today()
+            product = self.create_product('Snapshot Second UoM', kg, unit)
+            Configuration.write([Configuration(1)], {
+                    'second_quantity_snapshot': True,
+                    })
+
+            for second_quantity in [2, 3]:
+                company = self.create_company()
+                moves = self.create_moves(company, [{
+                            'product': product,
+                            'quantity': second_quantity * 10,
+                            'second_quantity': second_quantity,
+                            'from_location': supplier,
+                            'to_location': storage,
+                            'effective_date': today,
+                            }] * 2)
+                self.move.do(moves)
+
+            with Transaction().set_context(second_uom=True,
+                    stock_date_end=today):
+                self.assertIsNotNone(
+                    Snapshot.compute_quantities_query([storage.id]))
+                quantities = self.product.products_by_location(
+                    [storage.id], [product.id])
+            # Only the moves of the company of the user are counted
+            self.assertEqual(quantities[(storage.id, product.id)], 6)
+            rows = Snapshot.search_read([
+                    ('product', '=', product.id),
+                    ('location', '=', storage.id),
+                    ], fields_names=['second_internal_quantity'])
+            self.assertEqual(sorted(r['second_internal_quantity']
+                    for r in rows), [4, 6])
+
+            # The snapshot is not used with done moves dated in the future
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': 1,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': today + datetime.timedelta(1),
+                        }])
+            self.move.do(moves)
+            with Transaction().set_context(second_uom=True,
+                    stock_date_end=today):
+                self.assertIsNone(
+                    Snapshot.compute_quantities_query([storage.id]))
+                quantities = self.product.products_by_location(
+                    [storage.id], [product.id])
+            self.assertEqual(quantities[(storage.id, product.id)], 6)
+
+            Configuration.write([Configuration(1)], {
+                    'second_quantity_snapshot': False,
+                    })
+            with Transaction().set_context(second_uom=True,
+                    stock_date_end=today):
+                self.assertIsNone(
+                    Snapshot.compute_quantities_query([storage.id]))
+                quantities = self.product.products_by_location(
+                    [storage.id], [product.id])
+            self.assertEqual(quantities[(storage.id, product.id)], 6)
+
+    def test0140outgoing_second_quantities(self):
+        'Test share of inventory second quantities among outgoing moves'
+        ShipmentOut = POOL.get('stock.shipment.out')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            storage, customer = self.get_locations('STO', 'CUS')
+            product = self.create_product('Outgoing Second UoM', kg, unit)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': quantity,
+                        'second_quantity': second_quantity,
+                        'from_location': storage,
+                        'to_location': customer,
+                        } for quantity, second_quantity in [
+                        (1, None), (2, None), (4, 1)]])
+
+            to_write = ShipmentOut._get_outgoing_second_quantities(moves,
+                OrderedDict([(unit, 10)]))
+            self.assertEqual(to_write, [
+                    [moves[0]], {'second_quantity': 1, 'second_uom': unit.id},
+                    [moves[1]], {'second_quantity': 3, 'second_uom': unit.id},
+                    # The last move gets the rounding remainder
+                    [moves[2]], {'second_quantity': 7},
+                    ])
+            self.move.write(*to_write)
+            self.assertEqual(sum(m['second_quantity']
+                    for m in self.move.read([m.id for m in moves],
+                        ['second_quantity'])), 11)
+
+    def test0150period_close_second_quantities(self):
+        'Test second quantities kept while closing a period'
+        from trytond.modules.stock_second_uom.stock import (
+            instrumentation_stats, period_second_quantities,
+            period_second_quantities_key, pop_period_second_quantities)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage, customer = self.get_locations(
+                'SUP', 'STO', 'CUS')
+            today = self.date.today()
+            product = self.create_product('Period Second UoM', kg, unit)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': second_quantity * 10,
+                        'second_quantity': second_quantity,
+                        'from_location': from_location,
+                        'to_location': to_location,
+                        'effective_date': today - datetime.timedelta(days=2),
+                        } for second_quantity, from_location, to_location in [
+                        (2, supplier, storage), (3, supplier, storage),
+                        (1, storage, customer)]])
+            self.move.do(moves)
+            period, = self.period.create([{
+                        'date': today - datetime.timedelta(days=1),
+                        'company': company.id,
+                        }])
+
+            with Transaction().set_context(second_uom_instrumentation=True):
+                self.period.close([period])
+            # The second quantities are computed once with the quantities
+            stats = instrumentation_stats(reset=True)
+            self.assertEqual(stats['Move.compute_quantities_query']['calls'],
+                2 * len(self.period.groupings()))
+            self.assertFalse(period_second_quantities())
+            cache, = POOL.get('stock.period.cache').search_read([
+                    ('period', '=', period.id),
+                    ('product', '=', product.id),
+                    ('location', '=', storage.id),
+                    ], fields_names=['second_internal_quantity'])
+            self.assertEqual(cache['second_internal_quantity'], 4)
+
+            # The kept quantities are only used for the same company,
+            # locations and products
+            quantities = {}
+            key = period_second_quantities_key(('product',), today,
+                [storage.id, customer.id], None)
+            period_second_quantities()[key] = quantities
+            self.assertIsNone(pop_period_second_quantities(('product',),
+                    today, [supplier.id], [product.id]))
+            self.assertIsNone(pop_period_second_quantities(('product',),
+                    today - datetime.timedelta(days=1), [storage.id],
+                    [product.id]))
+            self.assertIs(pop_period_second_quantities(('product',),
+                    today, [storage.id], [product.id]), quantities)
+            self.assertFalse(period_second_quantities())
+
+    def test0160products_by_location_both(self):
+        'Test quantities and second quantities computed together'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage, customer = self.get_locations(
+                'SUP', 'STO', 'CUS')
+            products = [self.create_product('Both Second UoM', kg, unit)
+                for _ in range(2)]
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': second_quantity * 10,
+                        'second_quantity': second_quantity,
+                        'from_location': from_location,
+                        'to_location': to_location,
+                        'effective_date': self.date.today(),
+                        } for product in products
+                    for second_quantity, from_location, to_location in [
+                        (3, supplier, storage), (1, storage, customer)]])
+            self.move.do(moves)
+
+            location_ids = [storage.id, customer.id]
+            product_ids = [p.id for p in products]
+            with Transaction().set_context(stock_date_end=self.date.today()):
+                quantities, second_quantities = (
+                    self.product.products_by_location_both(location_ids,
+                        product_ids))
+                self.assertEqual(quantities,
+                    self.product.products_by_location(location_ids,
+                        product_ids))
+                with Transaction().set_context(second_uom=True):
+                    self.assertEqual(second_quantities,
+                        self.product.products_by_location(location_ids,
+                            product_ids))
+                self.assertEqual(second_quantities[
+                        (storage.id, products[0].id)], 2)
+
+                # The second quantities do not need more queries
+                self.assertEqual(
+                    self.count_queries(self.product.products_by_location_both,
+                        location_ids, product_ids),
+                    self.count_queries(self.product.products_by_location,
+                        location_ids, product_ids))
+
+    def test0170inventory_complete_lines(self):
+        'Test completion of inventory second quantities'
+        from trytond.modules.stock_second_uom.stock import (
+            instrumentation_stats)
+        Inventory = POOL.get('stock.inventory')
+        Line = POOL.get('stock.inventory.line')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            lost_found, = self.location.search([('type', '=', 'lost_found')])
+            product1, product2 = [
+                self.create_product('Inventory Second UoM', kg, unit)
+                for _ in range(2)]
+            product3 = self.create_product('Inventory Second UoM', kg, unit,
+                use_second_uom=False)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': second_quantity,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': self.date.today(),
+                        } for product, second_quantity in [
+                        (product1, 3), (product2, 2), (product3, None)]])
+            self.move.do(moves)
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'lost_found': lost_found.id,
+                        'company': company.id,
+                        'date': self.date.today(),
+                        }])
+
+            with Transaction().set_context(second_uom_instrumentation=True):
+                Inventory.complete_lines([inventory])
+            # One query for the quantities and one for the second quantities
+            stats = instrumentation_stats(reset=True)
+            self.assertEqual(stats['Move.compute_quantities_query']['calls'],
+                2)
+            lines = Line.search_read([
+                    ('inventory', '=', inventory.id),
+                    ('product', 'in', [product1.id, product2.id]),
+                    ], fields_names=['product', 'second_expected_quantity',
+                    'second_quantity'])
+            self.assertEqual(sorted((l['product'],
+                        l['second_expected_quantity'], l['second_quantity'])
+                    for l in lines),
+                [(product1.id, 3, 3), (product2.id, 2, 2)])
+
+            # Completing again does not change the lines
+            Inventory.complete_lines([inventory])
+            self.assertEqual(Line.search_count([
+                        ('inventory', '=', inventory.id),
+                        ]), 3)
+
+    def test0180template_second_quantity(self):
+        'Test second quantity of templates computed at once'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            products = [self.create_product('Template Second UoM', kg, unit)
+                for _ in range(5)]
+            templates = [p.template for p in products]
+            # A second variant for each template
+            variants = self.product.create([{
+                        'template': t.id,
+                        'use_second_uom': True,
+                        } for t in templates])
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': i + 1,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': self.date.today(),
+                        } for i, product in enumerate(products + variants)])
+            self.move.do(moves)
+
+            def read(templates):
+                return self.template.read([t.id for t in templates],
+                    ['second_quantity'])
+
+            with Transaction().set_context(locations=[storage.id],
+                    stock_date_end=self.date.today()):
+                self.assertEqual(sorted(t['second_quantity']
+                        for t in read(templates)), [7, 9, 11, 13, 15])
+                # The templates are computed with the same queries as one
+                self.assertEqual(self.count_queries(read, templates[1:2]),
+                    self.count_queries(read, templates[2:]))
+
+            # The inactive variants are counted
+            self.product.write([variants[0]], {
+                    'active': False,
+                    })
+            with Transaction().set_context(locations=[storage.id],
+                    stock_date_end=self.date.today()):
+                template, = read(templates[:1])
+                self.assertEqual(template['second_quantity'], 7)
+
+
+    def test0190inventory_confirm(self):
+        'Test second quantities of the moves of confirmed inventories'
+        Inventory = POOL.get('stock.inventory')
+        Line = POOL.get('stock.inventory.line')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            supplier, storage = self.get_locations('SUP', 'STO')
+            lost_found, = self.location.search([('type', '=', 'lost_found')])
+            product1, product2 = [
+                self.create_product('Inventory Second UoM', kg, unit)
+                for _ in range(2)]
+            product3 = self.create_product('Inventory Second UoM', kg, unit,
+                use_second_uom=False)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 10,
+                        'second_quantity': second_quantity,
+                        'from_location': supplier,
+                        'to_location': storage,
+                        'effective_date': self.date.today(),
+                        } for product, second_quantity in [
+                        (product1, 3), (product2, 2), (product3, None)]])
+            self.move.do(moves)
+            inventory, = Inventory.create([{
+                        'location': storage.id,
+                        'lost_found': lost_found.id,
+                        'company': company.id,
+                        'date': self.date.today(),
+                        }])
+            Inventory.complete_lines([inventory])
+            lines = dict((l.product, l) for l in inventory.lines)
+            Line.write([lines[product1]], {
+                    'quantity': 8,
+                    }, [lines[product2]], {
+                    'second_quantity': 3,
+                    }, [lines[product3]], {
+                    'quantity': 12,
+                    })
+
+            Inventory.confirm([inventory])
+            moves = self.move.search([
+                    ('origin', 'in', [str(l) for l in lines.values()]),
+                    ])
+            self.assertEqual(sorted((m.product.id, m.from_location.id,
+                        m.to_location.id, m.quantity, m.second_quantity)
+                    for m in moves), sorted([
+                        (product1.id, storage.id, lost_found.id, 2, 0),
+                        (product2.id, lost_found.id, storage.id, 0, 1),
+                        (product3.id, lost_found.id, storage.id, 2, None),
+                        ]))
+            self.assertTrue(all(m.state == 'done' for m in moves))
+
+
+class LotTestCase(TestMixin, unittest.TestCase):
+    'Test module with stock_lot'
+    modules = ['stock_second_uom', 'stock_lot']
+
+    def test0010lot_second_uom_fields(self):
+        'Test second UoM fields of lots read in constant queries'
+        Lot = POOL.get('stock.lot')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, unit = self.get_uoms('Kilogram', 'Unit')
+            products = [self.create_product('Lot Second UoM %s' % i, kg, unit,
+                    use_second_uom=bool(i % 2)) for i in range(40)]
+            lots = Lot.create([{
+                        'number': str(i),
+                        'product': p.id,
+                        } for i, p in enumerate(products)])
+
+            fields = ['product', 'use_second_uom', 'second_uom']
+            ids = [l.id for l in lots]
+            counts = [self.count_queries(Lot.read, ids[:n], fields)
+                for n in (2, 10, 40)]
+            self.assertEqual(len(set(counts)), 1, counts)
+
+            for value in Lot.read(ids, fields):
+                product = self.product(value['product'])
+                self.assertEqual(value['use_second_uom'],
+                    product.use_second_uom)
+                self.assertEqual(value['second_uom'], unit.id)
+
+
+class SaleTestCase(TestMixin, unittest.TestCase):
+    'Test module with sale'
+    modules = ['stock_second_uom', 'sale']
+
+    def setUp(self):
+        super(SaleTestCase, self).setUp()
+        self.sale = POOL.get('sale.sale')
+        self.sale_line = POOL.get('sale.line')
+
+    def create_sale(self, company, lines):
+        "Create a draft sale of company with lines of product and quantities"
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{
+                                    'type': 'remainder',
+                                    }])],
+                    }])
+        customer, = self.party.create([{
+                    'name': 'Customer',
+                    }])
+        warehouse, = self.get_locations('WH')
+        sale, = self.sale.create([{
+                    'company': company.id,
+                    'party': customer.id,
+                    'currency': company.currency.id,
+                    'payment_term': payment_term.id,
+                    'warehouse': warehouse.id,
+                    'invoice_method': 'manual',
+                    'shipment_method': 'order',
+                    'lines': [('create', [{
+                                    'type': 'line',
+                                    'product': product.id,
+                                    'description': product.rec_name,
+                                    'quantity': quantity,
+                                    'unit': product.default_uom.id,
+                                    'unit_price': Decimal(1),
+                                    'second_quantity': second_quantity,
+                                    'second_unit': (product.second_uom.id
+                                        if product.use_second_uom else None),
+                                    } for product, quantity, second_quantity
+                                in lines])],
+                    }])
+        return sale
+
+    def test0010moved_second_quantities(self):
+        'Test moved second quantities of sale lines'
+        Recreated = POOL.get('sale.line-recreated-stock.move')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            unit, kg, gram = self.get_uoms('Unit', 'Kilogram', 'Gram')
+            storage, customer = self.get_locations('STO', 'CUS')
+            product = self.create_product('Sale Second UoM', unit, kg)
+            sale = self.create_sale(company, [(product, 10, 3),
+                    (product, 5, 2), (product, 1, 1)])
+            line1, line2, line3 = lines = sorted(sale.lines,
+                key=lambda l: l.id)
+            moves = self.create_moves(company, [{
+                        'product': product,
+                        'quantity': 1,
+                        'second_quantity': second_quantity,
+                        'second_uom': second_uom,
+                        'from_location': storage,
+                        'to_location': customer,
+                        'origin': str(line),
+                        } for line, second_quantity, second_uom in [
+                        (line1, 500, gram), (line1, 500, gram), (line1, 1, kg),
+                        (line2, 1, kg),
+                        (line3, 4, gram), (line3, 4, gram), (line3, 4, gram),
+                        ]])
+            # The recreated moves are not counted
+            Recreated.create([{
+                        'sale_line': line2.id,
+                        'move': moves[3].id,
+                        }])
+
+            # Each move is rounded to the second unit of the line
+            self.assertEqual(self.sale_line.get_moved_second_quantities(lines),
+                {line1.id: 2, line2.id: 0, line3.id: 0})
+            # The lines are computed with one query
+            self.assertEqual(self.count_queries(
+                    self.sale_line.get_moved_second_quantities, lines), 1)
+
+    def test0020return_sale(self):
+        'Test second quantities of returned sales'
+        ReturnSale = POOL.get('sale.return_sale', type='wizard')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            unit, kg = self.get_uoms('Unit', 'Kilogram')
+            product = self.create_product('Return Second UoM', unit, kg)
+            product_wo_2uom = self.create_product('Return Second UoM', unit,
+                kg, use_second_uom=False)
+            sale = self.create_sale(company, [(product, 10, 3),
+                    (product, 5, 3), (product, 2, 1),
+                    (product_wo_2uom, 4, None)])
+
+            cursor = Transaction().cursor
+            execute = cursor.execute
+            updates = []
+
+            def counted_execute(query, *args, **kwargs):
+                if (query.startswith('UPDATE "sale_line"')
+                        and '"second_quantity"' in query):
+                    updates.append(query)
+                return execute(query, *args, **kwargs)
+
+            session_id, _, _ = ReturnSale.create()
+            return_sale = ReturnSale(session_id)
+            cursor.execute = counted_execute
+            try:
+                with Transaction().set_context(active_ids=[sale.id]):
+                    _, data = return_sale.do_return_({'views': []})
+            finally:
+                cursor.execute = execute
+
+            returned_sale, = self.sale.browse(data['res_id'])
+            self.assertEqual(sorted((l.quantity, l.second_quantity)
+                    for l in returned_sale.lines),
+                [(-10, -3), (-5, -3), (-4, None), (-2, -1)])
+            # The lines are written with one query by second quantity
+            self.assertEqual(len(updates), 2)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(LotTestCase))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SaleTestCase))
     suite.addTests(doctest.DocFileSuite('scenario_stock_second_uom.rst',
             setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))